@@ -0,0 +1,276 @@
+'''
+Benchmark the s3-site-cache-optimizer end-to-end on a synthetic website, against
+an in-memory stand-in for an S3 bucket.
+
+The site is generated from a fixed seed, so results of runs with the same
+parameters can be compared across commits.
+'''
+
+from __future__ import print_function, division
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from shutil import rmtree
+from tempfile import mkdtemp
+
+# benchmark the working tree, not an installed version, with the S3 stand-ins of the tests
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'tests'))
+
+from local_s3 import LocalBucket, LocalOptimizer, install  # noqa: E402
+
+
+ASSET_EXTENSIONS = ['.png', '.jpg', '.gif', '.svg', '.woff2']
+BINARY_EXTENSIONS = ['.mp4', '.webm']
+
+
+def generate_site(root, assets=500, pages=200, stylesheets=20, scripts=20, density=10,
+                  binaries=2, binary_size=32, seed=1):
+    '''
+    Generate a static website in root, with assets, html pages, stylesheets and scripts.
+    Every rewritable references `density` random assets. Binaries are large assets of
+    `binary_size` MB. Returns the number of files and their total size.
+    '''
+    rnd = random.Random(seed)
+    dirs = ['', 'img', 'img/icons', 'media', 'fonts', 'static/vendor']
+    files = [0, 0]
+
+    def _write(relpath, data):
+        path = os.path.join(root, relpath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        files[0] += 1
+        files[1] += len(data)
+
+    # files are slices of a block of random data, generating them byte by byte is slow
+    block = bytes(bytearray(rnd.getrandbits(8) for _ in range(1024 * 1024)))
+
+    def _data(size):
+        offset = rnd.randint(0, len(block) - size)
+        return block[offset:offset + size]
+
+    asset_paths = []
+    for i in range(assets):
+        relpath = '{0}/asset{1}{2}'.format(rnd.choice(dirs), i, rnd.choice(ASSET_EXTENSIONS))
+        relpath = relpath.lstrip('/')
+        _write(relpath, _data(rnd.randint(100, 20000)))
+        asset_paths.append(relpath)
+
+    for i in range(binaries):
+        relpath = 'media/video{0}{1}'.format(i, rnd.choice(BINARY_EXTENSIONS))
+        _write(relpath, block * binary_size)
+        asset_paths.append(relpath)
+
+    css_paths = ['css/style{0}.css'.format(i) for i in range(stylesheets)]
+    for i, relpath in enumerate(css_paths):
+        lines = ['.c{0} {{ background: url(../{1}); }}'.format(j, a)
+                 for j, a in enumerate(rnd.sample(asset_paths, min(density, len(asset_paths))))]
+        # stylesheets import a later one, so there are no circular references
+        if i + 1 < len(css_paths):
+            lines.append('@import "{0}";'.format(
+                os.path.basename(rnd.choice(css_paths[i + 1:]))))
+        _write(relpath, '\n'.join(lines * 5).encode('utf-8'))
+
+    js_paths = ['js/app{0}.js'.format(i) for i in range(scripts)]
+    for relpath in js_paths:
+        refs = rnd.sample(asset_paths, min(density, len(asset_paths)))
+        lines = ['var images = [{0}];'.format(', '.join('"/{0}"'.format(a) for a in refs))]
+        lines.extend('function f{0}(x) {{ return x * {0}; }}'.format(j) for j in range(100))
+        _write(relpath, '\n'.join(lines).encode('utf-8'))
+
+    for i in range(pages):
+        subdir = rnd.choice(['', 'blog', 'blog/2016', 'docs'])
+        up = '../' * (subdir.count('/') + 1) if subdir else ''
+        lines = ['<!DOCTYPE html>', '<html><head>']
+        lines.extend('<link rel="stylesheet" href="{0}{1}">'.format(up, p)
+                     for p in rnd.sample(css_paths, min(2, len(css_paths))))
+        lines.extend('<script src="/{0}"></script>'.format(p)
+                     for p in rnd.sample(js_paths, min(2, len(js_paths))))
+        lines.append('</head><body>')
+        for a in rnd.sample(asset_paths, min(density, len(asset_paths))):
+            lines.append(rnd.choice(['<img src="/{0}">', '<img src="{1}{0}">',
+                                     '<a href="http://www.example.com/{0}">link</a>'])
+                         .format(a, up))
+            lines.append('<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit.</p>')
+        lines.append('</body></html>')
+        _write(os.path.join(subdir, 'page{0}.html'.format(i)), '\n'.join(lines).encode('utf-8'))
+
+    return files[0], files[1]
+
+
+def run_optimizer(source_dir, bucket, options):
+    '''
+    Run the optimizer once, and return its report
+    '''
+    output_dir = mkdtemp()
+    report_file = os.path.join(output_dir, 'report.json')
+    options = dict(options, output_dir=os.path.join(output_dir, 'site'), report=report_file)
+
+    LocalOptimizer.bucket = bucket
+    try:
+        start = time.time()
+        LocalOptimizer(source_dir, bucket.name, **options).run()
+        wall = time.time() - start
+        with open(report_file) as f:
+            report = json.load(f)
+    finally:
+        rmtree(output_dir)
+
+    report['total'] = wall
+    return report
+
+
+def summarize(reports):
+    '''
+    Combine the reports of repeated runs of a scenario, taking the median of each timing
+    '''
+    def _median(values):
+        values = sorted(values)
+        return values[len(values) // 2]
+
+    phases = []
+    for i, phase in enumerate(reports[0]['phases']):
+        phases.append({'name': phase['name'], 'files': phase['files'], 'bytes': phase['bytes'],
+                       'wall': _median([r['phases'][i]['wall'] for r in reports]),
+                       'cpu': _median([r['phases'][i]['cpu'] for r in reports])})
+
+    return {'phases': phases, 's3_requests': reports[0]['s3_requests'],
+            'total': _median([r['total'] for r in reports])}
+
+
+def benchmark(args):
+    '''
+    Run every scenario on a generated site, and return the results
+    '''
+    options = {'domains': ['www.example.com'], 'gzip': args.gzip, 'brotli': args.brotli,
+               'jobs': args.jobs, 'upload_concurrency': args.upload_concurrency,
+               'multipart_threshold': args.multipart_threshold * 1024 * 1024}
+
+    work_dir = mkdtemp()
+    try:
+        source_dir = os.path.join(work_dir, 'site')
+        files, size = generate_site(source_dir, assets=args.assets, pages=args.pages,
+                                    stylesheets=args.stylesheets, scripts=args.scripts,
+                                    density=args.density, binaries=args.binaries,
+                                    binary_size=args.binary_size, seed=args.seed)
+        print("Generated {0} files ({1:.1f} MB)".format(files, size / 1024 / 1024),
+              file=sys.stderr)
+
+        # cold: every file is uploaded to an empty bucket
+        # unchanged: the same site is uploaded again, nothing should be sent
+        scenarios = {'cold': [], 'unchanged': []}
+        for _ in range(args.repeat):
+            bucket = LocalBucket(args.bucket, latency=args.latency / 1000)
+            scenarios['cold'].append(run_optimizer(source_dir, bucket, options))
+            scenarios['unchanged'].append(run_optimizer(source_dir, bucket, options))
+    finally:
+        rmtree(work_dir)
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        commit = commit.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'commit': commit, 'python': platform.python_version(),
+            'site': {'files': files, 'bytes': size},
+            'parameters': dict((k, v) for k, v in vars(args).items()
+                               if k not in ('output', 'compare')),
+            'scenarios': dict((name, summarize(reports))
+                              for name, reports in scenarios.items())}
+
+
+def print_results(results, baseline=None):
+    '''
+    Print the results as a table, compared to a baseline when given
+    '''
+    print("commit {0}, Python {1}, {2} files ({3:.1f} MB)".format(
+        results['commit'], results['python'], results['site']['files'],
+        results['site']['bytes'] / 1024 / 1024))
+
+    for name in sorted(results['scenarios']):
+        scenario = results['scenarios'][name]
+        base = None
+        if baseline:
+            base = baseline['scenarios'].get(name)
+
+        print()
+        print("{0:<16} {1:>7} {2:>10} {3:>9} {4:>9} {5:>9}".format(
+            name, 'files', 'MB', 'wall (s)', 'cpu (s)', 'baseline' if base else ''))
+
+        base_phases = dict((p['name'], p) for p in base['phases']) if base else {}
+        rows = [(p['name'], p['files'], p['bytes'] / 1024 / 1024, p['wall'], p['cpu'])
+                for p in scenario['phases']]
+        rows.append(('total', '', '', scenario['total'], ''))
+        for row_name, files, size, wall, cpu in rows:
+            if row_name == 'total' and base:
+                base_wall = base['total']
+            else:
+                base_wall = base_phases.get(row_name, {}).get('wall')
+            change = ''
+            if base_wall:
+                change = '{0:+.0%}'.format(wall / base_wall - 1)
+            print("{0:<16} {1:>7} {2:>10} {3:>9.3f} {4:>9} {5:>9}".format(
+                row_name, files, '{0:.2f}'.format(size) if size != '' else '', wall,
+                '{0:.3f}'.format(cpu) if cpu != '' else '', change))
+
+        requests = ', '.join('{0} {1}'.format(k, v)
+                             for k, v in sorted(scenario['s3_requests'].items()))
+        print("S3 requests: {0}".format(requests or 'none'))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the s3-site-cache-optimizer on a synthetic website.')
+    parser.add_argument('--assets', type=int, default=500, help='Number of small assets.')
+    parser.add_argument('--pages', type=int, default=200, help='Number of html pages.')
+    parser.add_argument('--stylesheets', type=int, default=20, help='Number of css files.')
+    parser.add_argument('--scripts', type=int, default=20, help='Number of js files.')
+    parser.add_argument('--density', type=int, default=10,
+                        help='Number of asset references in every rewritable.')
+    parser.add_argument('--binaries', type=int, default=2, help='Number of large assets.')
+    parser.add_argument('--binary-size', type=int, default=32, metavar='MB',
+                        help='Size of every large asset.')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the generated site.')
+    parser.add_argument('--gzip', action='store_true', help='Gzip text-based files.')
+    parser.add_argument('--brotli', action='store_true', help='Write Brotli variants.')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--upload-concurrency', type=int, default=1)
+    parser.add_argument('--multipart-threshold', type=int, default=64, metavar='MB')
+    parser.add_argument('--latency', type=float, default=0, metavar='MS',
+                        help='Simulated latency of every S3 request.')
+    parser.add_argument('--bucket', default='benchmark', help='Name of the stand-in bucket.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of runs, the median timings are reported.')
+    parser.add_argument('-o', '--output', help='Write the results to this file as JSON.')
+    parser.add_argument('--compare', metavar='RESULTS',
+                        help='Compare to results of a previous benchmark.')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    install()
+
+    results = benchmark(args)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -18,5 +18,6 @@ setup(
     package_dir={'': 'src'},
 
     install_requires=['boto'],
+    extras_require={'brotli': ['brotli'], 'xxhash': ['xxhash']},
     entry_points={'console_scripts': ['s3-site-cache-optimizer=s3_site_cache_optimizer.optimize:main']},
 )
@@ -8,23 +8,59 @@ headers.
 from __future__ import print_function
 
 import argparse
+import cProfile
+import errno
 import os
+import sys
 import logging
+import mmap
 import re
 import gzip
+import json
+import mimetypes
+import socket
+import threading
+import time
 from pkg_resources import require
-from hashlib import sha256
+from binascii import unhexlify
+from contextlib import contextmanager
+from hashlib import md5, sha256
 from shutil import copyfile, move, rmtree
-from fnmatch import fnmatch
+from fnmatch import translate
+from functools import partial
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from tempfile import mkdtemp, mkstemp
 try:
     from urlparse import urlparse, urljoin
 except ImportError:
     from urllib.parse import urlparse, urljoin
 
+try:
+    from fcntl import ioctl
+except ImportError:
+    ioctl = None
+
+try:
+    from brotli import Compressor as BrotliCompressor
+except ImportError:
+    BrotliCompressor = None
+
+try:
+    from hashlib import blake2b
+except ImportError:
+    blake2b = None
+
+try:
+    from xxhash import xxh64
+except ImportError:
+    xxh64 = None
+
 from boto import connect_s3
 from boto.s3 import connect_to_region
 from boto.s3.key import Key
+from boto.s3.multipart import MultiPartUpload
+from boto.utils import compute_md5
 from boto.exception import BotoClientError, BotoServerError
 
 __author__ = "Ruben Van den Bossche"
@@ -34,13 +70,31 @@ __license__ = "MIT"
 
 logger = logging.getLogger('s3-site-cache-optimizer')
 
+# characters that can be part of a (relative) url referencing an asset
+URL_CHARS = '''a-z0-9''' + re.escape('''-_.~!#$&*+,/:;=?@[]''')
+
+# the same characters as single bytes, to find the start of a url around a match
+URL_BYTES = frozenset(c for c in (bytes(bytearray([i])) for i in range(128))
+                      if re.match(('[' + URL_CHARS + ']').encode('ascii'), c, re.IGNORECASE))
+
+
+def new_hasher(algorithm='sha256'):
+    '''
+    Return a new hash object of one of HASH_ALGORITHMS
+    '''
+    if algorithm == 'blake2b':
+        # as long as a sha256 digest
+        return blake2b(digest_size=32)
+    if algorithm == 'xxh64':
+        return xxh64()
+    return sha256()
 
-def calculate_fingerprint(fname):
+
+def calculate_fingerprint(fname, algorithm='sha256', blocksize=65536):
     '''
     Calculate a hash from a file name.
     '''
-    hasher = sha256()
-    blocksize = 65536
+    hasher = new_hasher(algorithm)
 
     with open(fname, 'rb') as f:
         buf = f.read(blocksize)
@@ -61,6 +115,284 @@ def convert_filename(filename, filehash):
     return ftup[0] + '.' + filehash + ftup[1]
 
 
+def to_bytes(s):
+    '''
+    Encode a string as UTF-8, unless it already is bytes
+    '''
+    if isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
+
+
+@contextmanager
+def read_buffer(fname):
+    '''
+    Yield the contents of a file as bytes. Files of at least MMAP_THRESHOLD bytes are
+    memory-mapped instead of read.
+    '''
+    with open(fname, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < MMAP_THRESHOLD:
+            yield f.read()
+            return
+
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield buf
+        finally:
+            buf.close()
+
+
+def write_range(f, buf, start, end):
+    '''
+    Write a range of a buffer to a file, in blocks of COPY_BLOCKSIZE bytes so a large
+    memory-mapped range is never copied into memory at once.
+    '''
+    for pos in range(start, end, COPY_BLOCKSIZE):
+        f.write(buf[pos:min(pos + COPY_BLOCKSIZE, end)])
+
+
+def link_file(src, dst, link_mode='copy'):
+    '''
+    Place the contents of src at dst, by copying it or by linking to it. Falls back
+    to copying when the link can't be made, e.g. across filesystems.
+    '''
+
+    # never write through an existing link into the source file
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    if link_mode != 'copy':
+        try:
+            if link_mode == 'hardlink':
+                os.link(src, dst)
+            elif link_mode == 'symlink':
+                os.symlink(os.path.abspath(src), dst)
+            elif link_mode == 'reflink':
+                if ioctl is None or not sys.platform.startswith('linux'):
+                    raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported')
+                with open(src, 'rb') as f_src:
+                    with open(dst, 'wb') as f_dst:
+                        ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+            return
+        except (OSError, IOError) as e:
+            logger.debug("Can't {0} {1} to {2}, copying instead: {3}"
+                         .format(link_mode, src, dst, e))
+
+    copyfile(src, dst)
+
+
+def cpu_time():
+    '''
+    Return the CPU time used by this process and its finished child processes.
+    '''
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def compile_patterns(patterns):
+    '''
+    Compile shell-style patterns into a single function that returns whether a path
+    matches any of them, like fnmatch.
+    '''
+    if not patterns:
+        return lambda path: False
+
+    regex = re.compile('|'.join('(?:' + translate(os.path.normcase(pattern)) + ')'
+                                for pattern in patterns))
+    return lambda path: regex.match(os.path.normcase(path)) is not None
+
+
+def calculate_part_md5s(fname, part_size):
+    '''
+    Calculate the MD5 of each part of a file, as a list of (hex digest, base64 digest, size)
+    tuples.
+    '''
+    parts = []
+    with open(fname, 'rb') as f:
+        while True:
+            part_md5 = compute_md5(f, size=part_size)
+            if part_md5[2] == 0 and parts:
+                break
+            parts.append(part_md5)
+            f.seek(part_md5[2], os.SEEK_CUR)
+            if part_md5[2] < part_size:
+                break
+    return parts
+
+
+def multipart_etag(parts):
+    '''
+    Calculate the ETag S3 gives to a file uploaded with multipart upload, from the MD5s of
+    its parts.
+    '''
+    hasher = md5()
+    for part_md5 in parts:
+        hasher.update(unhexlify(part_md5[0]))
+    return '{0}-{1}'.format(hasher.hexdigest(), len(parts))
+
+
+def build_trie_pattern(words):
+    '''
+    Build a regular expression pattern matching any of the given words.
+
+    Common prefixes are factored out into a trie, so the compiled expression
+    scans a line once instead of trying every word at every position.
+    '''
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = None
+
+    def _pattern(node):
+        end = '' in node
+        alternatives = [re.escape(char) + _pattern(node[char])
+                        for char in sorted(node) if char != '']
+        if not alternatives:
+            return ''
+        if len(alternatives) == 1 and not end:
+            return alternatives[0]
+        pattern = '(?:' + '|'.join(alternatives) + ')'
+        if end:
+            pattern += '?'
+        return pattern
+
+    return _pattern(trie)
+
+
+def headers_digest(headers):
+    '''
+    Calculate a digest of the headers of a key, to find keys whose headers changed
+    '''
+    return md5(json.dumps(headers, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def strongly_connected_components(graph):
+    '''
+    Find the strongly connected components of a graph given as a dict of nodes and the
+    sets of nodes they reference, with Tarjan's algorithm. Every component is returned
+    after the components it references.
+    '''
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+
+    for root in sorted(graph):
+        if root in index:
+            continue
+
+        # iterative depth-first search, with the remaining references of every node
+        work = [(root, iter(sorted(graph[root])))]
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, references = work[-1]
+            for reference in references:
+                if reference not in index:
+                    index[reference] = lowlink[reference] = len(index)
+                    stack.append(reference)
+                    on_stack.add(reference)
+                    work.append((reference, iter(sorted(graph[reference]))))
+                    break
+                elif reference in on_stack:
+                    lowlink[node] = min(lowlink[node], index[reference])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = set()
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.add(member)
+                        if member == node:
+                            break
+                    components.append(component)
+
+    return components
+
+
+# file in the output dir recording the inputs of every output, for incremental runs
+DEPENDENCIES_FILENAME = '.s3-site-cache-optimizer-deps.json'
+
+# number of times a failed upload is retried, and the delay before the first retry
+# in seconds, doubled on every next retry
+UPLOAD_RETRIES = 3
+UPLOAD_RETRY_DELAY = 0.5
+
+# files of at least this size are uploaded in parts of MULTIPART_PART_SIZE bytes
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+MULTIPART_PART_SIZE = 16 * 1024 * 1024
+
+# maximum number of keys S3 deletes in a single request
+DELETE_BATCH_SIZE = 1000
+
+# dir in which the single copy of assets with identical contents is written
+DEDUPE_DIR = '_assets'
+
+# object in the bucket with the digests of the headers of every key, the bucket listing
+# doesn't include headers
+HEADERS_FILENAME = '.s3-site-cache-optimizer-headers.json'
+
+# files up to this size get new headers by copying them in place, larger files are
+# uploaded again
+COPY_MAX_SIZE = 5 * 1024 * 1024 * 1024
+
+# upload policy rule fields, and the headers they set
+POLICY_HEADERS = {'cache_control': 'Cache-Control', 'content_type': 'Content-Type',
+                  'storage_class': 'x-amz-storage-class'}
+
+# seconds between polls of the source dir in watch mode
+WATCH_INTERVAL = 0.5
+
+# hash algorithms used for fingerprints, blake2b requires Python 3.6 and xxh64 the
+# xxhash module
+HASH_ALGORITHMS = ('sha256', 'blake2b', 'xxh64')
+
+# minimum number of characters of the fingerprint in filenames, shorter fingerprints of
+# different contents collide too often
+FINGERPRINT_MIN_LENGTH = 8
+
+# ways to place files that are not rewritten into the output dir
+LINK_MODES = ('copy', 'hardlink', 'reflink', 'symlink')
+
+# ioctl cloning a file on Linux filesystems with reflink support (btrfs, xfs)
+FICLONE = 0x40049409
+
+# size of the chunks in which files are compressed
+COMPRESS_BLOCKSIZE = 65536
+
+# rewritables of at least this size are memory-mapped instead of read into memory
+MMAP_THRESHOLD = 1024 * 1024
+
+# size of the chunks in which unchanged parts of rewritables are written
+COPY_BLOCKSIZE = 1024 * 1024
+
+# Optimizer instance used by the processes of a worker pool
+_worker_optimizer = None
+
+
+def _init_worker(optimizer):
+    '''
+    Initialize a worker process with a copy of the Optimizer.
+    '''
+    global _worker_optimizer
+    _worker_optimizer = optimizer
+
+
+def _call_worker(method, item):
+    '''
+    Call an Optimizer method from a worker process.
+    '''
+    return getattr(_worker_optimizer, method)(item)
+
+
 class OptimizerError(Exception):
 
     '''
@@ -82,13 +414,22 @@ class Optimizer(object):
 
     def __init__(self, source_dir, destination_bucket, exclude=[], skip_assets=[], output_dir=None,
                  aws_access_key_id=None, aws_secret_access_key=None, skip_s3_upload=False,
-                 region=None, domains=[], prefix=None, gzip=False):
+                 region=None, domains=[], prefix=None, gzip=False, jobs=1,
+                 cache=None, incremental=False, upload_concurrency=1,
+                 multipart_threshold=MULTIPART_THRESHOLD, dry_run=False, gzip_level=9,
+                 brotli=False, brotli_level=11, stream=False, link_mode='copy',
+                 report=None, profile=None, manifest=None, from_manifest=None,
+                 hash_algorithm='sha256', hash_blocksize=65536, fingerprint_length=None,
+                 watch=False, dedupe=None, policy=None, plan=None):
         '''
         Initialize Optimizer
         '''
 
         logger.info('Initialize Optimizer class')
 
+        # nothing to delete until the temporary output dir is created, see __del__
+        self._output_dir_is_temp = False
+
         if not os.path.isdir(source_dir):
             raise OptimizerError("{0} is not a valid path".format(source_dir))
 
@@ -96,8 +437,8 @@ class Optimizer(object):
             raise OptimizerError(
                 "{0} is not a readable dir".format(source_dir))
 
-        if output_dir is not None:
-            output_dir_is_temp = False
+        output_dir_is_temp = output_dir is None
+        if not output_dir_is_temp:
             if not os.path.isdir(output_dir):
                 try:
                     os.makedirs(output_dir)
@@ -107,8 +448,64 @@ class Optimizer(object):
 
             if not os.access(output_dir, os.W_OK):
                 raise OptimizerError("{0} is not a writable dir".format(output_dir))
-        else:
-            output_dir_is_temp = True
+
+        if watch and output_dir_is_temp:
+            raise OptimizerError("Watch mode requires an output dir")
+
+        if watch and (stream or dry_run):
+            raise OptimizerError("Watch mode can't be combined with streaming or a dry run")
+
+        if watch:
+            # rebuilds only write the files affected by a change
+            incremental = True
+
+        if incremental and output_dir_is_temp:
+            raise OptimizerError("Incremental mode requires an output dir")
+
+        if jobs < 1:
+            raise OptimizerError("Number of jobs should be at least 1")
+
+        if upload_concurrency < 1:
+            raise OptimizerError("Upload concurrency should be at least 1")
+
+        if not 1 <= gzip_level <= 9:
+            raise OptimizerError("Gzip level should be between 1 and 9")
+
+        if brotli and BrotliCompressor is None:
+            raise OptimizerError("Brotli compression requires the brotli module")
+
+        if not 0 <= brotli_level <= 11:
+            raise OptimizerError("Brotli level should be between 0 and 11")
+
+        if hash_algorithm not in HASH_ALGORITHMS:
+            raise OptimizerError("Hash algorithm should be one of {0}"
+                                 .format(', '.join(HASH_ALGORITHMS)))
+
+        if hash_algorithm == 'blake2b' and blake2b is None:
+            raise OptimizerError("The blake2b hash algorithm requires Python 3.6 or later")
+
+        if hash_algorithm == 'xxh64' and xxh64 is None:
+            raise OptimizerError("The xxh64 hash algorithm requires the xxhash module")
+
+        if hash_blocksize < 1:
+            raise OptimizerError("Hash buffer size should be at least 1 byte")
+
+        if fingerprint_length is not None and fingerprint_length < FINGERPRINT_MIN_LENGTH:
+            raise OptimizerError("Fingerprint length should be at least {0}"
+                                 .format(FINGERPRINT_MIN_LENGTH))
+
+        if link_mode not in LINK_MODES:
+            raise OptimizerError("Link mode should be one of {0}".format(', '.join(LINK_MODES)))
+
+        if stream and (skip_s3_upload or dry_run or incremental):
+            raise OptimizerError("Streaming can't be combined with skipping the upload, "
+                                 "a dry run or incremental mode")
+
+        if stream and plan:
+            raise OptimizerError("Streaming uploads files before they are all planned, "
+                                 "an upload plan can't be written")
+
+        if output_dir_is_temp:
             output_dir = mkdtemp()
 
         self._assets_ext = ['.css', '.svg', '.ttf', '.woff', '.woff2', '.otf', '.eot', '.png',
@@ -124,6 +521,9 @@ class Optimizer(object):
         self._subdirs = []
         self._files = []
         self._assets_map = {}
+        self._external_assets = set()
+        self._manifest_filename = manifest
+        self._from_manifest_filename = from_manifest
         self._rewritables = []
         self._exclude = exclude
         self._skip_assets = skip_assets
@@ -131,26 +531,133 @@ class Optimizer(object):
         self._prefix = prefix
         self._gzip = gzip
         self._skip_s3_upload = skip_s3_upload
+        self._jobs = jobs
+        self._cache_filename = cache
+        self._fingerprint_cache = {}
+        self._hash_algorithm = hash_algorithm
+        self._hash_blocksize = hash_blocksize
+        self._fingerprint_length = fingerprint_length
+        self._fingerprints = {}
+        self._incremental = incremental
+        self._dependencies = {}
+        self._source_fingerprints = {}
+        self._watch = watch
+        self._dedupe_dir = dedupe
+        self._plan_filename = plan
+        self._policy = self._load_policy(policy) if policy else []
+        self._fingerprinted_keys = set()
+        self._written_files = []
+        self._removed_files = []
+        self._url_re = None
+        self._basenames_re = None
+        self._fallback_assets = []
+        self._resolved_urls = {}
+        self._asset_levels = []
+        self._asset_references = {}
+        self._circular_references = {}
+        self._stats = {'phases': [], 's3_requests': {}}
+        self._stats_lock = threading.Lock()
+        self._report_filename = report
+        self._profile_filename = profile
+        self._profiler = cProfile.Profile() if profile else None
+        self._aws_access_key_id = aws_access_key_id
+        self._aws_secret_access_key = aws_secret_access_key
+        self._region = region
+        self._upload_concurrency = upload_concurrency
+        self._multipart_threshold = multipart_threshold
+        self._dry_run = dry_run
+        self._gzip_level = gzip_level
+        self._brotli = brotli
+        self._brotli_level = brotli_level
+        self._stream = stream
+        self._link_mode = link_mode
+        self._stream_sources = {}
+        self._upload_pool = None
+        self._stream_results = []
+        self._local_keys = set()
+        self._local = threading.local()
+        self._remote_keys = {}
+        self._remote_headers = {}
+        self._saved_remote_headers = {}
 
         if not self._skip_s3_upload:
-            try:
-                if not region:
-                    self._s3 = connect_s3(aws_access_key_id=aws_access_key_id,
-                                          aws_secret_access_key=aws_secret_access_key)
-                else:
-                    self._s3 = connect_to_region(region, aws_access_key_id=aws_access_key_id,
-                                                 aws_secret_access_key=aws_secret_access_key)
-            except (BotoClientError, BotoServerError):
-                raise OptimizerError("Cannot connect to S3")
-
-            try:
-                self._bucket = self._s3.get_bucket(self._destination_bucket)
-            except (BotoClientError, BotoServerError):
-                raise OptimizerError("Bucket {0} does not exist or is not accessible."
-                                     .format(self._destination_bucket))
+            self._s3, self._bucket = self._connect_bucket()
+            # used by this thread when uploading in parallel
+            self._local.bucket = self._bucket
 
         logger.debug('Optimizer class initialized')
 
+    def _connect_bucket(self, validate=True):
+        '''
+        Open a connection to S3, and return the connection and the destination bucket.
+        When validate is set, a request checks that the bucket exists.
+        '''
+        try:
+            if not self._region:
+                s3 = connect_s3(aws_access_key_id=self._aws_access_key_id,
+                                aws_secret_access_key=self._aws_secret_access_key)
+            else:
+                s3 = connect_to_region(self._region, aws_access_key_id=self._aws_access_key_id,
+                                       aws_secret_access_key=self._aws_secret_access_key)
+        except (BotoClientError, BotoServerError):
+            raise OptimizerError("Cannot connect to S3")
+
+        try:
+            if validate:
+                self._count_request('GET_BUCKET')
+            bucket = s3.get_bucket(self._destination_bucket, validate=validate)
+        except (BotoClientError, BotoServerError):
+            raise OptimizerError("Bucket {0} does not exist or is not accessible."
+                                 .format(self._destination_bucket))
+
+        return s3, bucket
+
+    def _thread_bucket(self):
+        '''
+        Return the destination bucket for the current thread. Boto connections can't be
+        shared between threads, so every upload thread opens and reuses its own. The
+        bucket was validated by the first connection.
+        '''
+        if self._upload_concurrency == 1:
+            return self._bucket
+
+        try:
+            return self._local.bucket
+        except AttributeError:
+            s3, self._local.bucket = self._connect_bucket(validate=False)
+            return self._local.bucket
+
+    def _upload_workers(self):
+        '''
+        Return the pool of upload threads. It is kept for the whole run, or for as long as
+        the source dir is watched, so every thread keeps its connection.
+        '''
+        if self._upload_pool is None:
+            self._upload_pool = ThreadPool(self._upload_concurrency)
+        return self._upload_pool
+
+    def _close_upload_workers(self, terminate=False):
+        '''
+        Stop the upload threads, after they finished their work unless terminating
+        '''
+        if self._upload_pool is not None:
+            if terminate:
+                self._upload_pool.terminate()
+            else:
+                self._upload_pool.close()
+            self._upload_pool.join()
+            self._upload_pool = None
+
+    def _upload_map(self, method, items):
+        '''
+        Call a method for each item with the upload threads. Results are returned in order.
+        '''
+        items = list(items)
+        if self._upload_concurrency == 1 or len(items) < 2:
+            return [getattr(self, method)(item) for item in items]
+
+        return self._upload_workers().map(getattr(self, method), items, 1)
+
     def __del__(self):
         if self._output_dir_is_temp:
             try:
@@ -159,34 +666,173 @@ class Optimizer(object):
             except OSError:
                 raise OptimizerError("Can't delete temporary directory.")
 
-    def _index_source_dir(self):
+    def __getstate__(self):
+        '''
+        State sent to worker processes: the S3 connection is left out, and the copy
+        should never remove the output directory.
         '''
-        Index all files and directories under the source directory
+        state = self.__dict__.copy()
+        state.pop('_s3', None)
+        state.pop('_bucket', None)
+        state.pop('_local', None)
+        state.pop('_stats_lock', None)
+        state.pop('_profiler', None)
+        state.pop('_upload_pool', None)
+        state.pop('_stream_results', None)
+        state['_output_dir_is_temp'] = False
+        return state
+
+    def __setstate__(self, state):
         '''
+        Restore the state sent to a worker process, without the left out attributes
+        '''
+        self.__dict__.update(state)
+        self._s3 = self._bucket = None
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._profiler = None
+        self._upload_pool = None
+        self._stream_results = []
+
+    def _start_phase(self, name):
+        '''
+        Start measuring a phase of the run
+        '''
+        return {'name': name, 'wall': time.time(), 'cpu': cpu_time()}
+
+    def _end_phase(self, phase, files=0, size=0):
+        '''
+        Stop measuring a phase of the run, and add it to the stats with the number of
+        files and bytes it processed
+        '''
+        phase['wall'] = time.time() - phase['wall']
+        phase['cpu'] = cpu_time() - phase['cpu']
+        phase['files'] = files
+        phase['bytes'] = size
+        phase['throughput'] = size / phase['wall'] if phase['wall'] > 0 else 0.0
+        self._stats['phases'].append(phase)
+
+        logger.debug("Phase {name}: {files} files, {bytes} bytes in {wall:.2f}s "
+                     "(CPU {cpu:.2f}s)".format(**phase))
+
+    def _count_request(self, request_type, count=1):
+        '''
+        Count requests sent to S3, by type
+        '''
+        with self._stats_lock:
+            requests = self._stats['s3_requests']
+            requests[request_type] = requests.get(request_type, 0) + count
+
+    def _source_size(self, src_filenames):
+        '''
+        Return the total size of files in the source dir
+        '''
+        return sum(os.path.getsize(os.path.join(self._source_dir, src_filename))
+                   for src_filename in src_filenames)
+
+    def _write_report(self):
+        '''
+        Write the stats of the run as JSON
+        '''
+        logger.debug("Writing report {0}".format(self._report_filename))
+
+        report = {'phases': self._stats['phases'],
+                  's3_requests': self._stats['s3_requests'],
+                  'wall': sum(phase['wall'] for phase in self._stats['phases']),
+                  'cpu': sum(phase['cpu'] for phase in self._stats['phases'])}
+        try:
+            with open(self._report_filename, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+        except (IOError, OSError) as e:
+            raise OptimizerError("Can't write report {0}: {1}".format(self._report_filename, e))
+
+    def _map(self, method, items, processes=False):
+        '''
+        Call a method for each item, using a pool of workers when multiple jobs are
+        configured. Threads are used for work that releases the GIL (hashing and copying),
+        processes for work in pure python. Results are returned in order.
+        '''
+        return list(self._imap(method, items, processes))
+
+    def _imap(self, method, items, processes=False):
+        '''
+        Like _map, but yield every result as soon as it is ready.
+        '''
+        items = list(items)
+        workers = self._jobs
+        if processes and self._profiler is not None:
+            # only rewrites in this process can be profiled
+            workers = 1
+        if workers == 1 or len(items) < 2:
+            for item in items:
+                yield getattr(self, method)(item)
+            return
+
+        if processes:
+            pool = Pool(workers, _init_worker, (self,))
+            func = partial(_call_worker, method)
+        else:
+            pool = ThreadPool(workers)
+            func = getattr(self, method)
+
+        try:
+            for result in pool.imap(func, items, max(1, len(items) // (workers * 4))):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+
+    def _walk_source_dir(self):
+        '''
+        Yield the subdirs and files of every directory under the source directory that
+        are not excluded. Excluded directories are not walked.
+        '''
+        is_excluded = compile_patterns(self._exclude)
 
-        logger.info('Indexing source dir')
         for dirpath, dirnames, fnames in os.walk(self._source_dir):
 
+            reldirpath = os.path.relpath(dirpath, self._source_dir)
+            if reldirpath == os.curdir:
+                reldirpath = ''
+
+            included = []
             for d in dirnames:
-                relpath = os.path.relpath(
-                    os.path.join(dirpath, d), self._source_dir)
-                if True in [fnmatch(relpath, exclude) for exclude in self._exclude]:
+                relpath = os.path.join(reldirpath, d)
+                if is_excluded(relpath):
+                    logger.debug("Excluding subdir {0}".format(relpath))
                     continue
+                included.append(d)
+
+            # prune excluded dirs from the walk
+            dirnames[:] = included
+
+            yield ([os.path.join(reldirpath, d) for d in included],
+                   [os.path.join(reldirpath, f) for f in fnames
+                    if not is_excluded(os.path.join(reldirpath, f))])
+
+    def _index_source_dir(self):
+        '''
+        Index all files and directories under the source directory. Excluded directories
+        are not walked.
+        '''
 
+        logger.info('Indexing source dir')
+        phase = self._start_phase('index')
+
+        is_skipped_asset = compile_patterns(self._skip_assets)
+
+        for subdirs, files in self._walk_source_dir():
+            for relpath in subdirs:
                 logger.debug("Found subdir {0}".format(relpath))
                 self._subdirs.append(relpath)
 
-            for f in fnames:
-                relpath = os.path.relpath(
-                    os.path.join(dirpath, f), self._source_dir)
-                if True in [fnmatch(relpath, exclude) for exclude in self._exclude]:
-                    continue
-
+            for relpath in files:
+                f = os.path.basename(relpath)
                 self._files.append(relpath)
 
                 ext = os.path.splitext(f)[1]
                 if ext in self._assets_ext:
-                    if any(fnmatch(relpath, skip) for skip in self._skip_assets):
+                    if is_skipped_asset(relpath):
                         logger.debug("Skipping asset {0}".format(f))
                     else:
                         logger.debug("Found asset {0}".format(f))
@@ -197,28 +843,304 @@ class Optimizer(object):
                     logger.debug("Found rewritable {0}".format(f))
                     self._rewritables.append(relpath)
 
+        if self._from_manifest_filename:
+            self._load_manifest()
+
+        self._end_phase(phase, len(self._files))
+
+        phase = self._start_phase('reference_graph')
+        self._compile_rewrite_matcher()
+        self._build_reference_graph()
+        nodes = [node for level in self._asset_levels for node in level]
+        self._end_phase(phase, len(nodes), self._source_size(nodes))
+
         logger.debug('Finished indexing source dir')
 
     def _calculate_fingerprints(self):
         '''
-        Calculate fingerprints of all assets in the source dir
+        Calculate fingerprints of all assets in the source dir. In incremental mode, the
+        fingerprints of all other source files are calculated as well.
         '''
 
         logger.info('Calculating fingerprints')
+        phase = self._start_phase('fingerprints')
+
+        if self._cache_filename and not self._fingerprint_cache:
+            # in watch mode, the fingerprints of previous builds are kept in memory
+            self._load_fingerprint_cache()
 
-        for fname in self._assets_map.keys():
-            fingerprint = calculate_fingerprint(os.path.join(self._source_dir, fname))
-            self._assets_map[fname]['new_filename'] = convert_filename(fname, fingerprint)
+        if self._incremental:
+            self._dependencies = self._load_dependencies()
+            if not self._cache_filename:
+                self._load_dependency_signatures()
 
+        fnames = sorted(set(self._assets_map.keys()) - self._external_assets)
+        rewritables = set(self._rewritables)
+        fingerprints = self._map('_calculate_fingerprint', fnames)
+        self._source_fingerprints = dict(zip(fnames, fingerprints))
+        for fname, fingerprint in zip(fnames, fingerprints):
+            self._assets_map[fname]['fingerprint'] = fingerprint
+            self._assets_map[fname]['new_filename'] = self._fingerprinted_name(fname,
+                                                                               fingerprint)
+
+        if self._dedupe_dir:
+            self._dedupe_assets([fname for fname in fnames if fname not in rewritables])
+
+        self._fingerprints = {}
+        for fname, fingerprint in zip(fnames, fingerprints):
+            if fname not in rewritables:
+                # rewritables are named after the fingerprint of their output
+                self._check_fingerprint(fname, self._assets_map[fname]['new_filename'],
+                                        fingerprint)
+
+        if self._incremental:
+            # sources of the outputs, to find the outputs that have to be written again
+            sources = sorted((rewritables | set(self._files)) - set(fnames))
+            self._source_fingerprints.update(zip(sources, self._map('_calculate_fingerprint',
+                                                                    sources)))
+            fnames += sources
+
+        if self._cache_filename:
+            self._save_fingerprint_cache()
+
+        self._end_phase(phase, len(fnames), self._source_size(fnames))
         logger.debug('Finished calculating fingerprints')
 
+    def _calculate_fingerprint(self, fname):
+        '''
+        Calculate the fingerprint of a single asset in the source dir. When the file's size,
+        modification time and inode match the fingerprint cache, the file is not read.
+        '''
+        abspath = os.path.abspath(os.path.join(self._source_dir, fname))
+        if not self._cache_filename and not self._watch and not self._incremental:
+            return self._hash_file(abspath)
+
+        st = os.stat(abspath)
+        signature = [st.st_size, st.st_mtime, st.st_ino]
+
+        entry = self._fingerprint_cache.get(abspath)
+        if entry is not None and entry['signature'] == signature:
+            logger.debug("Fingerprint of {0} found in cache".format(abspath))
+            entry['used'] = True
+            return entry['fingerprint']
+
+        fingerprint = self._hash_file(abspath)
+        self._fingerprint_cache[abspath] = {'signature': signature, 'fingerprint': fingerprint,
+                                            'used': True}
+        return fingerprint
+
+    def _hash_file(self, fname):
+        '''
+        Calculate the fingerprint of a file with the configured hash algorithm
+        '''
+        return calculate_fingerprint(fname, self._hash_algorithm, self._hash_blocksize)
+
+    def _fingerprinted_name(self, fname, fingerprint):
+        '''
+        Return the name of a file including its fingerprint, truncated to the configured
+        fingerprint length
+        '''
+        return convert_filename(fname, fingerprint[:self._fingerprint_length])
+
+    def _dedupe_name(self, fname, fingerprint):
+        '''
+        Return the name in the dedupe dir of the single copy of assets with identical
+        contents
+        '''
+        return os.path.join(self._dedupe_dir,
+                            self._fingerprinted_name(os.path.basename(fname), fingerprint))
+
+    def _dedupe_assets(self, fnames):
+        '''
+        Give assets with identical contents a single fingerprinted name in the dedupe dir,
+        so they are written and uploaded once
+        '''
+        groups = {}
+        for fname in sorted(fnames):
+            key = (self._assets_map[fname]['fingerprint'], os.path.splitext(fname)[1])
+            groups.setdefault(key, []).append(fname)
+
+        for (fingerprint, ext), group in groups.items():
+            if len(group) < 2:
+                continue
+
+            new_filename = self._dedupe_name(group[0], fingerprint)
+            logger.debug("Deduplicating {0} to {1}".format(', '.join(group), new_filename))
+            for fname in group:
+                self._assets_map[fname]['new_filename'] = new_filename
+
+    def _dedupe_rewritten(self, src_filenames, results):
+        '''
+        Move a single copy of rewritten assets with identical contents to the dedupe dir,
+        and remove the others. Returns the names and references of the rewritten assets.
+        '''
+        groups = {}
+        for src_filename, (dst_filename, references, fingerprint) in zip(src_filenames,
+                                                                          results):
+            key = (fingerprint, os.path.splitext(src_filename)[1])
+            groups.setdefault(key, []).append((src_filename, dst_filename))
+
+        deduped = {}
+        for (fingerprint, ext), group in groups.items():
+            if len(group) < 2:
+                continue
+
+            dst_filenames = [dst_filename for src_filename, dst_filename in group]
+            new_filename = self._dedupe_name(group[0][0], fingerprint)
+            logger.debug("Deduplicating {0} to {1}".format(', '.join(dst_filenames),
+                                                           new_filename))
+            move(os.path.join(self._output_dir, dst_filenames[0]),
+                 os.path.join(self._output_dir, new_filename))
+            for dst_filename in dst_filenames[1:]:
+                os.remove(os.path.join(self._output_dir, dst_filename))
+            for dst_filename in dst_filenames:
+                deduped[dst_filename] = new_filename
+
+        return [(deduped.get(dst_filename, dst_filename), references)
+                for dst_filename, references, fingerprint in results]
+
+    def _check_fingerprint(self, fname, new_filename, fingerprint):
+        '''
+        Check that the fingerprinted name of a file is not the same as the one of a file
+        with different contents, which can happen when fingerprints are truncated. Either
+        file could then be served for the other.
+        '''
+        other_fingerprint, other_fname = self._fingerprints.setdefault(new_filename,
+                                                                       (fingerprint, fname))
+        if other_fingerprint != fingerprint:
+            raise OptimizerError("Fingerprints of {0} and {1} collide, use a longer "
+                                 "fingerprint length".format(other_fname, fname))
+
+    def _load_fingerprint_cache(self):
+        '''
+        Load the fingerprint cache file, if it exists. Fingerprints calculated with another
+        hash algorithm are not used.
+        '''
+        self._fingerprint_cache = {}
+        if not os.path.isfile(self._cache_filename):
+            return
+
+        logger.debug("Loading fingerprint cache {0}".format(self._cache_filename))
+        try:
+            with open(self._cache_filename, 'r') as f:
+                cache = json.load(f)
+            if cache.get('hash') != self._hash_algorithm:
+                logger.debug("Fingerprint cache {0} uses another hash algorithm"
+                             .format(self._cache_filename))
+                return
+            for abspath, (size, mtime, inode, fingerprint) in cache['files'].items():
+                self._fingerprint_cache[abspath] = {'signature': [size, mtime, inode],
+                                                    'fingerprint': fingerprint, 'used': False}
+        except (IOError, ValueError, TypeError, KeyError, AttributeError) as e:
+            logger.warning("Ignoring invalid fingerprint cache {0}: {1}"
+                           .format(self._cache_filename, e))
+            self._fingerprint_cache = {}
+
+    def _load_dependency_signatures(self):
+        '''
+        Fill the fingerprint cache from the signatures of the sources in the dependency
+        manifest, so unchanged sources are not read in incremental mode without a cache file
+        '''
+        if self._dependencies.get('state', {}).get('hash') != [self._hash_algorithm,
+                                                                self._fingerprint_length]:
+            return
+
+        for src_filename, entry in self._dependencies.get('files', {}).items():
+            if entry.get('signature') and entry['fingerprint']:
+                abspath = os.path.abspath(os.path.join(self._source_dir, src_filename))
+                self._fingerprint_cache.setdefault(abspath, {
+                    'signature': entry['signature'], 'fingerprint': entry['fingerprint'],
+                    'used': False})
+
+    def _save_fingerprint_cache(self):
+        '''
+        Write the fingerprint cache file. Entries of files that no longer exist are evicted.
+        '''
+        entries = {}
+        for abspath, entry in self._fingerprint_cache.items():
+            if not entry['used'] and not os.path.isfile(abspath):
+                logger.debug("Evicting {0} from fingerprint cache".format(abspath))
+                continue
+            entries[abspath] = entry['signature'] + [entry['fingerprint']]
+
+        logger.debug("Writing fingerprint cache {0}".format(self._cache_filename))
+        try:
+            cache_dir = os.path.dirname(os.path.abspath(self._cache_filename))
+            tmp_handle, tmp_filename = mkstemp(dir=cache_dir)
+            with os.fdopen(tmp_handle, 'w') as f:
+                json.dump({'hash': self._hash_algorithm, 'files': entries}, f, sort_keys=True)
+            move(tmp_filename, self._cache_filename)
+        except (IOError, OSError) as e:
+            raise OptimizerError("Can't write fingerprint cache {0}: {1}"
+                                 .format(self._cache_filename, e))
+
+    def _load_manifest(self):
+        '''
+        Load the fingerprinted names of assets from a manifest written by another run. These
+        assets are referenced by their name in the manifest, and are not fingerprinted,
+        written or uploaded by this run, nor deleted from the bucket.
+        '''
+        logger.debug("Loading manifest {0}".format(self._from_manifest_filename))
+        try:
+            with open(self._from_manifest_filename, 'r') as f:
+                entries = json.load(f)['assets']
+            assets = {}
+            for src_filename, entry in entries.items():
+                assets[src_filename] = {'basename': os.path.basename(src_filename),
+                                        'fingerprint': entry['hash'],
+                                        'new_filename': entry['path'],
+                                        'size': entry['size']}
+        except (IOError, ValueError, TypeError, KeyError, AttributeError) as e:
+            raise OptimizerError("Can't read manifest {0}: {1}"
+                                 .format(self._from_manifest_filename, e))
+
+        self._assets_map.update(assets)
+        self._external_assets = set(assets)
+        self._files = [f for f in self._files if f not in self._external_assets]
+        self._rewritables = [f for f in self._rewritables if f not in self._external_assets]
+
+        logger.debug("Loaded {0} assets from manifest".format(len(assets)))
+
+    def _write_manifest(self):
+        '''
+        Write the fingerprinted name, fingerprint and size of every asset as JSON
+        '''
+        logger.debug("Writing manifest {0}".format(self._manifest_filename))
+
+        entries = {}
+        for src_filename, asset in self._assets_map.items():
+            # rewritten assets are named after the fingerprint of their output
+            fingerprint = os.path.splitext(asset['new_filename'])[0].rsplit('.', 1)[-1]
+            entries[src_filename] = {'path': asset['new_filename'], 'hash': fingerprint,
+                                     'size': asset['size']}
+        try:
+            with open(self._manifest_filename, 'w') as f:
+                json.dump({'assets': entries}, f, indent=2, sort_keys=True)
+        except (IOError, OSError) as e:
+            raise OptimizerError("Can't write manifest {0}: {1}"
+                                 .format(self._manifest_filename, e))
+
+    def _external_keys(self):
+        '''
+        Return the keys in the bucket of assets from the input manifest, with their Brotli
+        variants
+        '''
+        keys = set()
+        for asset in self._external_assets:
+            key = self._bucket_key(self._assets_map[asset]['new_filename'])
+            keys.update([key, key + '.br'])
+        return keys
+
     def _write_dirs(self):
         '''
         Write directory structure to output folder
         '''
 
         logger.info('Writing dirs')
-        for reldir in self._subdirs:
+        subdirs = self._subdirs
+        if self._dedupe_dir:
+            subdirs = subdirs + [self._dedupe_dir]
+        for reldir in subdirs:
             absdir = os.path.join(self._output_dir, reldir)
             if not os.path.isdir(absdir):
                 logger.debug("Making dir {0}".format(absdir))
@@ -226,206 +1148,1250 @@ class Optimizer(object):
 
         logger.debug('Finished writing dirs')
 
+    def _compile_rewrite_matcher(self):
+        '''
+        Compile the expressions used to find asset urls in rewritables
+        '''
+
+        logger.debug('Compiling rewrite matcher')
+
+        # rewritables are matched as bytes, whatever their encoding
+        url_chars = ('[' + URL_CHARS + ']').encode('ascii')
+        self._url_re = re.compile(url_chars + b'+', re.IGNORECASE)
+        self._resolved_urls = {}
+        self._fallback_assets = []
+
+        basenames = set()
+        for asset in self._assets_map.keys():
+            basename = to_bytes(self._assets_map[asset]['basename'])
+            match = self._url_re.match(basename)
+            if match and match.end() == len(basename):
+                basenames.add(basename.decode('ascii'))
+            else:
+                # basename contains characters that are not allowed in urls, the url
+                # around it can't be found by extending the match to the url characters
+                regex = url_chars + b'*' + re.escape(basename) + url_chars + b'*'
+                self._fallback_assets.append((asset, basename,
+                                              re.compile(regex, re.IGNORECASE)))
+
+        if basenames:
+            self._basenames_re = re.compile(build_trie_pattern(basenames).encode('ascii'))
+        else:
+            self._basenames_re = None
+
+    def _resolve_url(self, src_reldirpath, url):
+        '''
+        Resolve a url found in a rewritable to the asset it references. Returns a tuple
+        of the asset (or None) and the parsed url. Results are cached per source dir.
+        '''
+
+        cache_key = (src_reldirpath, url)
+        try:
+            return self._resolved_urls[cache_key]
+        except KeyError:
+            pass
+
+        try:
+            parsed_url = urlparse(url)
+        except ValueError:
+            parsed_url = None
+
+        asset = None
+        if parsed_url is not None:
+            normalized_relative_path = os.path.normpath(
+                os.path.join(src_reldirpath, parsed_url.path)).lstrip('/')
+            if normalized_relative_path in self._assets_map:
+                asset = normalized_relative_path
+
+        self._resolved_urls[cache_key] = (asset, parsed_url)
+        return asset, parsed_url
+
+    def _rewrite_url(self, src, url, asset, parsed_url):
+        '''
+        Return the rewritten url referencing the fingerprinted asset, or None if the url
+        should be left alone.
+        '''
+
+        if parsed_url.netloc and parsed_url.netloc not in self._domains:
+            # leave this url alone, is third party
+            logger.warning("Skipping rewriting url {0}.".format(url))
+            return None
+
+        logger.debug("Found asset {0} in {1}".format(url, src))
+        new_path = '/' + self._assets_map[asset]['new_filename']
+
+        if parsed_url.netloc:
+            # don't remove domain from absolute urls
+            new_path = urljoin(url, new_path)
+
+        logger.debug("Replacing with {0}".format(new_path))
+        return new_path
+
+    def _find_asset_urls(self, src_reldirpath, buf):
+        '''
+        Yield the start, end, url, asset and parsed url of every url in the contents of a
+        rewritable that references an asset, in order of their position. The contents are
+        bytes, so the encoding of the rewritable doesn't matter.
+        '''
+        found = []
+
+        if self._basenames_re is not None:
+            end = 0
+            for result in self._basenames_re.finditer(buf):
+                if result.start() < end:
+                    # part of the previous url
+                    continue
+
+                # extend the basename to the url around it
+                start = result.start()
+                while start > 0 and buf[start - 1:start] in URL_BYTES:
+                    start -= 1
+                end = self._url_re.match(buf, result.start()).end()
+
+                url = buf[start:end].decode('ascii')
+                asset, parsed_url = self._resolve_url(src_reldirpath, url)
+                if asset is not None:
+                    found.append((start, end, url, asset, parsed_url))
+
+        for asset, basename, regex in self._fallback_assets:
+            if buf.find(basename) == -1:
+                continue
+
+            for result in regex.finditer(buf):
+                try:
+                    url = result.group().decode('utf-8')
+                except UnicodeDecodeError:
+                    continue
+                asset_found, parsed_url = self._resolve_url(src_reldirpath, url)
+                if asset_found == asset:
+                    found.append((result.start(), result.end(), url, asset, parsed_url))
+
+        # skip urls overlapping an earlier one
+        end = 0
+        for item in sorted(found, key=lambda item: item[0]):
+            if item[0] >= end:
+                end = item[1]
+                yield item
+
+    def _find_references(self, src_filename):
+        '''
+        Return the assets referenced by a rewritable in the source dir
+        '''
+        src = os.path.join(self._source_dir, src_filename)
+        src_reldirpath = os.path.dirname(src_filename)
+
+        references = set()
+        with read_buffer(src) as buf:
+            for start, end, url, asset, parsed_url in self._find_asset_urls(src_reldirpath,
+                                                                             buf):
+                if not parsed_url.netloc or parsed_url.netloc in self._domains:
+                    references.add(asset)
+
+        return references
+
+    def _build_reference_graph(self):
+        '''
+        Find the references between assets that are also rewritables, and sort them into
+        levels: the assets of a level only reference assets of earlier levels, so they
+        can be rewritten in parallel once those are fingerprinted.
+        '''
+        logger.debug('Building reference graph')
+
+        nodes = set(self._assets_map.keys()) & set(self._rewritables)
+
+        # in watch mode, the references of unchanged files are kept between rebuilds
+        pending = sorted(nodes - set(self._asset_references))
+        self._asset_references.update(zip(pending, self._map('_find_references', pending,
+                                                             processes=True)))
+
+        graph = dict((node, self._asset_references[node] & nodes) for node in nodes)
+
+        # assets referencing each other (or themselves) can't contain each other's
+        # fingerprint, those references are not rewritten
+        self._circular_references = {}
+        levels = {}
+        for component in strongly_connected_components(graph):
+            if len(component) > 1 or component & graph[next(iter(component))]:
+                logger.warning("Circular references between {0} are not rewritten, these "
+                               "assets are also written under their original names"
+                               .format(', '.join(sorted(component))))
+                for node in component:
+                    self._circular_references[node] = graph[node] & component
+
+            level = max([levels[dep] + 1 for node in component
+                         for dep in graph[node] - component] or [0])
+            for node in component:
+                levels[node] = level
+
+        self._asset_levels = [[] for i in range(max(levels.values()) + 1 if levels else 0)]
+        for node in sorted(levels):
+            self._asset_levels[levels[node]].append(node)
+
     def _rewrite_file(self, src, dst):
         '''
-        rewrite a single file from source to dest
+        rewrite a single file from source to dest, and return the fingerprinted names of
+        the assets it references
+        '''
+
+        if self._url_re is None:
+            self._compile_rewrite_matcher()
+
+        if self._profiler is not None:
+            return self._profiler.runcall(self._rewrite_contents, src, dst)
+        return self._rewrite_contents(src, dst)
+
+    def _rewrite_contents(self, src, dst):
+        '''
+        Rewrite the contents of a file, see _rewrite_file
+        '''
+        src_filename = os.path.relpath(src, self._source_dir)
+        src_reldirpath = os.path.dirname(src_filename)
+        circular = self._circular_references.get(src_filename, ())
+
+        references = {}
+        with read_buffer(src) as buf:
+            with open(dst, 'wb') as f_dst:
+                # write the contents between the asset urls, and the rewritten urls
+                pos = 0
+                for start, end, url, asset, parsed_url in self._find_asset_urls(
+                        src_reldirpath, buf):
+                    if asset in circular:
+                        continue
+                    new_path = self._rewrite_url(src, url, asset, parsed_url)
+                    if new_path is None:
+                        continue
+                    references[asset] = self._assets_map[asset]['new_filename']
+
+                    write_range(f_dst, buf, pos, start)
+                    f_dst.write(to_bytes(new_path))
+                    pos = end
+
+                write_range(f_dst, buf, pos, len(buf))
+
+        return references
+
+    def _write_asset(self, src_filename):
         '''
+        Copy an asset that is not a rewritable to its fingerprinted name
+        '''
+        dst_filename = self._assets_map[src_filename]['new_filename']
+
+        src = os.path.join(self._source_dir, src_filename)
+        dest = os.path.join(self._output_dir, dst_filename)
 
-        with open(src, 'r') as f_src:
-            src_reldirpath = os.path.dirname(os.path.relpath(src, self._source_dir))
+        if self._stream and self._output_dir_is_temp:
+            # uploaded straight from the source dir
+            self._stream_sources[dst_filename] = src
+            return dst_filename, {}
 
-            with open(dst, 'w') as f_dst:
-                # replace asset urls line by line
-                for line in f_src:
-                    for asset in self._assets_map.keys():
-                        if self._assets_map[asset]['basename'] in line:
-                            url_chars = '''a-z0-9''' + re.escape('''-_.~!#$&*+,/:;=?@[]''')
-                            regex = r'''[''' + url_chars + ''']*''' + \
-                                    re.escape(self._assets_map[asset]['basename']) + \
-                                    '[' + url_chars + ']*'
+        logger.debug("1. Writing asset {0} to {1}".format(src_filename, dst_filename))
+        link_file(src, dest, self._link_mode)
 
-                            it = re.finditer(regex, line, re.IGNORECASE)
-                            for result in reversed(list(it)):
-                                url = result.group()
-                                parsed_url = urlparse(url)
-                                if parsed_url.netloc and \
-                                        parsed_url.netloc not in self._domains:
-                                    # leave this url alone, is third party
-                                    logger.warning("Skipping rewriting url {0}.".format(url))
-                                    continue
-                                logger.debug("Found asset {0} in {1}".format(url, src))
-                                normalized_relative_path = os.path.normpath(
-                                    os.path.join(src_reldirpath, parsed_url.path)).lstrip('/')
+        return dst_filename, {}
 
-                                if asset == normalized_relative_path:
-                                    new_path = '/' + os.path.join(
-                                        os.path.dirname(normalized_relative_path),
-                                        os.path.basename(self._assets_map[asset]['new_filename']))
+    def _write_rewritable_asset(self, src_filename):
+        '''
+        Rewrite an asset that is also a rewritable, and return its fingerprinted name,
+        the assets it references and the fingerprint of its output
+        '''
 
-                                    if parsed_url.netloc:
-                                        # don't remove domain from absolute urls
-                                        new_path = urljoin(url, new_path)
+        # make temp file
+        tmp_handle, tmp_filename = mkstemp(text=True)
+        os.close(tmp_handle)
 
-                                    logger.debug("Replacing with {0}".format(new_path))
+        src = os.path.join(self._source_dir, src_filename)
+        logger.debug("2. Rewriting asset {0} to temp file".format(src_filename))
+        references = self._rewrite_file(src, tmp_filename)
 
-                                    line = line[:result.start()] + new_path + line[result.end():]
+        # calculate fingerprint
+        fingerprint = self._hash_file(tmp_filename)
+        dst_filename = self._fingerprinted_name(src_filename, fingerprint)
+        self._assets_map[src_filename]['new_filename'] = dst_filename
 
-                    f_dst.write(line)
+        # move temp file to destination
+        dest = os.path.join(self._output_dir, dst_filename)
+
+        logger.debug("2. Writing asset {0} to {1}".format(src_filename, dst_filename))
+        move(tmp_filename, dest)
+
+        return dst_filename, references, fingerprint
+
+    def _write_rewritable(self, src_filename):
+        '''
+        Rewrite a rewritable that is not an asset
+        '''
+        src = os.path.join(self._source_dir, src_filename)
+        dest = os.path.join(self._output_dir, src_filename)
+
+        logger.debug("3. Rewriting asset {0}".format(src_filename))
+        return src_filename, self._rewrite_file(src, dest)
+
+    def _write_file(self, src_filename):
+        '''
+        Copy a file that is neither an asset nor a rewritable
+        '''
+        src = os.path.join(self._source_dir, src_filename)
+        dest = os.path.join(self._output_dir, src_filename)
+
+        if self._stream and self._output_dir_is_temp:
+            # uploaded straight from the source dir
+            self._stream_sources[src_filename] = src
+            return src_filename, {}
+
+        logger.debug("4. Copying file {0}".format(src_filename))
+        link_file(src, dest, self._link_mode)
+
+        return src_filename, {}
+
+    def _load_dependencies(self):
+        '''
+        Load the dependency manifest written by the previous incremental run
+        '''
+        path = os.path.join(self._output_dir, DEPENDENCIES_FILENAME)
+        if not os.path.isfile(path):
+            return {}
+
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError) as e:
+            logger.warning("Ignoring invalid dependency manifest {0}: {1}".format(path, e))
+            return {}
+
+    def _save_dependencies(self, dependencies):
+        '''
+        Write the dependency manifest of this run to the output folder
+        '''
+        path = os.path.join(self._output_dir, DEPENDENCIES_FILENAME)
+        try:
+            with open(path, 'w') as f:
+                json.dump(dependencies, f, sort_keys=True)
+        except (IOError, OSError) as e:
+            raise OptimizerError("Can't write dependency manifest {0}: {1}".format(path, e))
+
+    def _dependencies_state(self):
+        '''
+        State that all outputs of a run depend on. When it changes, nothing from a previous
+        run is reused.
+        '''
+        assets = sha256()
+        for asset in sorted(self._assets_map.keys()):
+            assets.update((asset + '\n').encode('utf-8'))
+
+        return {'assets': assets.hexdigest(), 'domains': sorted(self._domains),
+                'gzip': self._gzip and self._gzip_level,
+                'brotli': self._brotli and self._brotli_level,
+                'hash': [self._hash_algorithm, self._fingerprint_length],
+                'dedupe': self._dedupe_dir}
+
+    def _up_to_date_output(self, previous, src_filename, fingerprint, expected=None):
+        '''
+        Return the output written for a source file by the previous run, if the source and
+        all assets it references are unchanged and the output still exists. When the name
+        of the output is known in advance, it has to be the expected name.
+        '''
+        try:
+            entry = previous[src_filename]
+            dst_filename = entry['output']
+        except KeyError:
+            return None
+
+        if entry['fingerprint'] != fingerprint:
+            return None
+
+        if expected is not None and dst_filename != expected:
+            # e.g. an asset that is no longer deduplicated
+            return None
+
+        for asset, new_filename in entry['references'].items():
+            if asset not in self._assets_map or \
+                    self._assets_map[asset]['new_filename'] != new_filename:
+                return None
+
+        if not os.path.isfile(os.path.join(self._output_dir, dst_filename)):
+            return None
+
+        return dst_filename
 
     def _write_files(self):
         '''
         Write files to output folder, and rewrite file names/content if necessary.
+        In incremental mode, files whose inputs didn't change since the previous run
+        are not written again, and outputs of files that disappeared are removed.
         '''
 
         logger.info('Writing files')
-        assets = set(self._assets_map.keys())
+
+        assets = set(self._assets_map.keys()) - self._external_assets
         rewritables = set(self._rewritables)
+        others = set(self._files) - assets - rewritables
+
+        # source fingerprints and outputs of the previous run, by source file
+        fingerprints = self._source_fingerprints
+        previous = {}
+        manifest = self._dependencies
+        if self._incremental and manifest.get('state') == self._dependencies_state():
+            previous = manifest['files']
+
+        # references within cycles are not rewritten, so the assets they reference are
+        # also written under their original names
+        cycle_copies = set()
+        for references in self._circular_references.values():
+            cycle_copies.update(references)
+
+        dependencies = {}
+        self._written_files = []
+        self._removed_files = []
+        self._fingerprinted_keys = set()
+
+        def _record(src_filename, dst_filename, references):
+            abspath = os.path.abspath(os.path.join(self._source_dir, src_filename))
+            dependencies[src_filename] = {'output': dst_filename, 'references': references,
+                                          'fingerprint': fingerprints.get(src_filename),
+                                          'signature': self._fingerprint_cache.get(
+                                              abspath, {}).get('signature')}
+            if src_filename in assets:
+                self._assets_map[src_filename]['new_filename'] = dst_filename
+                self._fingerprinted_keys.add(self._bucket_key(dst_filename))
+                dst = os.path.join(self._output_dir, dst_filename)
+                if not os.path.isfile(dst):
+                    # not written to the output dir when streaming
+                    dst = os.path.join(self._source_dir, src_filename)
+                self._assets_map[src_filename]['size'] = os.path.getsize(dst)
+
+        def _pending(src_filenames, expected=False):
+            pending = []
+            for src_filename in src_filenames:
+                dst_filename = self._up_to_date_output(
+                    previous, src_filename, fingerprints.get(src_filename),
+                    self._assets_map[src_filename]['new_filename'] if expected else None)
+                if src_filename in cycle_copies and \
+                        not os.path.isfile(os.path.join(self._output_dir, src_filename)):
+                    dst_filename = None
+                if dst_filename is None:
+                    pending.append(src_filename)
+                else:
+                    logger.debug("Skipping unchanged file {0}".format(src_filename))
+                    _record(src_filename, dst_filename, previous[src_filename]['references'])
+            return pending
+
+        def _written(src_filenames, results):
+            for src_filename, (dst_filename, references) in zip(src_filenames, results):
+                _record(src_filename, dst_filename, references)
+                self._written_files.append(dst_filename)
+                if self._stream:
+                    self._stream_output(dst_filename)
 
         # (1) Assets that are not rewritables
-        for src_filename in assets - rewritables:
+        phase = self._start_phase('write_assets')
+        src_filenames = []
+        outputs = set()
+        for src_filename in _pending(sorted(assets - rewritables), expected=True):
             dst_filename = self._assets_map[src_filename]['new_filename']
+            if dst_filename in outputs:
+                # deduplicated, the output is written once
+                _record(src_filename, dst_filename, {})
+            else:
+                outputs.add(dst_filename)
+                src_filenames.append(src_filename)
+        _written(src_filenames, self._imap('_write_asset', src_filenames))
+        self._end_phase(phase, len(src_filenames), self._source_size(src_filenames))
+
+        # (2) Assets that are also rewritables, level by level of the reference graph,
+        # so every asset is rewritten after the assets it references
+        phase = self._start_phase('rewrite_assets')
+        written = []
+        for level in self._asset_levels:
+            if self._dedupe_dir:
+                # whether a rewritten asset shares its output with identical ones is only
+                # known after rewriting them all
+                src_filenames = list(level)
+            else:
+                src_filenames = _pending(level)
+            results = self._map('_write_rewritable_asset', src_filenames, processes=True)
+            fingerprints_written = [result[2] for result in results]
+            if self._dedupe_dir:
+                results = self._dedupe_rewritten(src_filenames, results)
+            else:
+                results = [result[:2] for result in results]
+            for src_filename, (dst_filename, references), fingerprint in zip(
+                    src_filenames, results, fingerprints_written):
+                self._check_fingerprint(src_filename, dst_filename, fingerprint)
+            copies = []
+            for src_filename, (dst_filename, references) in zip(src_filenames, results):
+                if src_filename in cycle_copies:
+                    logger.debug("Copying asset {0} to its original name".format(dst_filename))
+                    copyfile(os.path.join(self._output_dir, dst_filename),
+                             os.path.join(self._output_dir, src_filename))
+                    copies.append(src_filename)
+            written_filenames = []
+            written_results = []
+            for src_filename, (dst_filename, references) in zip(src_filenames, results):
+                if dst_filename in outputs:
+                    # deduplicated, the output is written once
+                    _record(src_filename, dst_filename, references)
+                else:
+                    outputs.add(dst_filename)
+                    written_filenames.append(src_filename)
+                    written_results.append((dst_filename, references))
+            _written(written_filenames, written_results)
+            for src_filename in copies:
+                self._written_files.append(src_filename)
+                if self._stream:
+                    self._stream_output(src_filename)
+            written.extend(src_filenames)
+        self._end_phase(phase, len(written), self._source_size(written))
 
-            src = os.path.join(self._source_dir, src_filename)
-            dest = os.path.join(self._output_dir, dst_filename)
+        # (3) Other rewritables
+        phase = self._start_phase('rewrite_files')
+        src_filenames = _pending(sorted(rewritables - assets))
+        _written(src_filenames, self._imap('_write_rewritable', src_filenames, processes=True))
+        self._end_phase(phase, len(src_filenames), self._source_size(src_filenames))
 
-            logger.debug("1. Writing asset {0} to {1}".format(src_filename, dst_filename))
-            copyfile(src, dest)
+        # (4) Other files
+        phase = self._start_phase('write_files')
+        src_filenames = _pending(sorted(others))
+        _written(src_filenames, self._imap('_write_file', src_filenames))
+        self._end_phase(phase, len(src_filenames), self._source_size(src_filenames))
+
+        if self._incremental:
+            # remove outputs of the previous run that are no longer produced
+            outputs = set(entry['output'] for entry in dependencies.values()) | cycle_copies
+            previous_outputs = [entry['output'] for entry in manifest.get('files', {}).values()]
+            for output in previous_outputs + manifest.get('copies', []):
+                stale = os.path.join(self._output_dir, output)
+                if output not in outputs and os.path.isfile(stale):
+                    logger.debug("Removing stale output {0}".format(output))
+                    self._removed_files.append(output)
+                    os.remove(stale)
+                    if os.path.isfile(stale + '.br'):
+                        os.remove(stale + '.br')
+
+            self._save_dependencies({'state': self._dependencies_state(),
+                                     'files': dependencies, 'copies': sorted(cycle_copies)})
 
-        # (2) Assets that are also rewritables
-        for src_filename in assets & rewritables:
-            # we assume these files don't have mutual references to eachother
-            # if they do, we need to build a dependency tree and solve order
-            # that way (TODO)
+        logger.debug('Finished writing files')
 
-            # make temp file
-            tmp_handle, tmp_filename = mkstemp(text=True)
+    def _compress_file(self, relpath, src=None):
+        '''
+        Compress a single text file in the output folder: a Brotli variant is written next
+        to it with a .br extension, and the file itself is gzipped in place. When src is
+        given, the uncompressed content is read from there instead.
+        '''
+        abspath = os.path.join(self._output_dir, relpath)
+        if src is None:
+            src = abspath
+
+        if self._brotli:
+            logger.debug('Compressing {0} with Brotli'.format(abspath))
+            compressor = BrotliCompressor(quality=self._brotli_level)
+            with open(src, 'rb') as f_in:
+                with open(abspath + '.br', 'wb') as f_out:
+                    buf = f_in.read(COMPRESS_BLOCKSIZE)
+                    while len(buf) > 0:
+                        f_out.write(compressor.process(buf))
+                        buf = f_in.read(COMPRESS_BLOCKSIZE)
+                    f_out.write(compressor.finish())
 
-            src = os.path.join(self._source_dir, src_filename)
-            logger.debug("2. Rewriting asset {0} to temp file".format(src_filename))
-            self._rewrite_file(src, tmp_filename)
+        if self._gzip:
+            tmp_handle, tmp_filename = mkstemp(dir=os.path.dirname(abspath))
+
+            logger.debug('Gzipping {0}'.format(abspath))
+            with open(src, 'rb') as f_in:
+                with os.fdopen(tmp_handle, 'wb') as f_tmp:
+                    # leave out name and timestamp, so unchanged files
+                    # keep the same MD5 and are not uploaded again
+                    with gzip.GzipFile(filename='', mode='wb', fileobj=f_tmp,
+                                       compresslevel=self._gzip_level, mtime=0) as f_out:
+                        buf = f_in.read(COMPRESS_BLOCKSIZE)
+                        while len(buf) > 0:
+                            f_out.write(buf)
+                            buf = f_in.read(COMPRESS_BLOCKSIZE)
+
+            # overwrite existing file
+            move(tmp_filename, abspath)
+
+    def _compress_files(self):
+        '''
+        Compress text files written to the output folder in this run. Files left untouched
+        by an incremental run were already compressed.
+        '''
 
-            # close temp file and calculate fingerprint
-            fingerprint = calculate_fingerprint(tmp_filename)
-            dst_filename = convert_filename(src_filename, fingerprint)
-            self._assets_map[src_filename]['new_filename'] = dst_filename
+        logger.info('Compressing files')
 
-            # move temp file to destination
-            dest = os.path.join(self._output_dir, dst_filename)
+        phase = self._start_phase('compress')
+        relpaths = [relpath for relpath in self._written_files
+                    if os.path.splitext(relpath)[1] in self._gzip_ext]
+        size = sum(os.path.getsize(os.path.join(self._output_dir, relpath))
+                   for relpath in relpaths)
+        self._map('_compress_file', relpaths)
+        self._end_phase(phase, len(relpaths), size)
 
-            logger.debug("2. Writing asset {0} to {1}".format(src_filename, dst_filename))
-            move(tmp_filename, dest)
+        logger.debug('Finished compressing files')
 
-        # (3) Other rewritables
-        for src_filename in rewritables - assets:
-            src = os.path.join(self._source_dir, src_filename)
-            dest = os.path.join(self._output_dir, src_filename)
+    def _load_policy(self, filename):
+        '''
+        Load the rules of an upload policy. Every rule has one or more patterns, and sets the
+        Cache-Control, Content-Type, storage class or metadata of the files matching them.
+        Returns a list of (match function, headers) tuples.
+        '''
+        try:
+            with open(filename, 'r') as f:
+                rules = json.load(f)['rules']
+        except (IOError, ValueError, TypeError, KeyError) as e:
+            raise OptimizerError("Can't read upload policy {0}: {1}".format(filename, e))
+
+        policy = []
+        for rule in rules:
+            rule = dict(rule)
+            patterns = rule.pop('pattern', None)
+            if not patterns:
+                raise OptimizerError("Rule without pattern in upload policy {0}"
+                                     .format(filename))
+            if not isinstance(patterns, list):
+                patterns = [patterns]
+
+            headers = {}
+            for name, value in rule.items():
+                if name == 'metadata':
+                    for key, meta_value in value.items():
+                        headers['x-amz-meta-' + key] = meta_value
+                elif name in POLICY_HEADERS:
+                    headers[POLICY_HEADERS[name]] = value
+                else:
+                    raise OptimizerError("Unknown field {0} in upload policy {1}"
+                                         .format(name, filename))
 
-            logger.debug("3. Rewriting asset {0}".format(src_filename))
-            self._rewrite_file(src, dest)
+            policy.append((compile_patterns(patterns), headers))
 
-        # (4) Other files
-        for src_filename in set(self._files) - assets - rewritables:
-            src = os.path.join(self._source_dir, src_filename)
-            dest = os.path.join(self._output_dir, src_filename)
+        return policy
 
-            logger.debug("4. Copying file {0}".format(src_filename))
-            copyfile(src, dest)
+    def _policy_headers(self, key):
+        '''
+        Return the headers set by the upload policy for a key. Rules are applied in order,
+        so later rules override earlier ones.
+        '''
+        if self._prefix:
+            key = os.path.relpath(key, self._prefix)
 
-        logger.debug('Finished writing files')
+        headers = {}
+        for matches, rule_headers in self._policy:
+            if matches(key):
+                headers.update(rule_headers)
+        return headers
+
+    def _write_plan(self, uploads, copies, skipped, to_be_deleted):
+        '''
+        Write the planned uploads, header updates, skipped keys and deletions as JSON, with
+        an estimate of the number of requests they take
+        '''
+        logger.debug("Writing upload plan {0}".format(self._plan_filename))
+
+        puts = []
+        requests = 0
+        for abspath, relpath, headers, file_md5, size in uploads:
+            parts = len(file_md5) if isinstance(file_md5, list) else 1
+            # a multipart upload is initiated and completed besides uploading its parts
+            requests += parts + 2 if isinstance(file_md5, list) else 1
+            puts.append({'key': relpath, 'size': size, 'parts': parts, 'headers': headers})
+        copied = [{'key': relpath, 'headers': headers}
+                  for abspath, relpath, headers, file_md5, size in copies]
+        requests += len(copied)
+        requests += (len(to_be_deleted) + DELETE_BATCH_SIZE - 1) // DELETE_BATCH_SIZE
+        if requests:
+            # the digests of the headers are written afterwards
+            requests += 1
+
+        plan = {'put': puts, 'copy': copied, 'skip': sorted(skipped), 'delete': to_be_deleted,
+                'totals': {'put': len(puts), 'bytes': sum(put['size'] for put in puts),
+                           'copy': len(copied), 'skip': len(skipped),
+                           'delete': len(to_be_deleted), 'requests': requests}}
+        try:
+            with open(self._plan_filename, 'w') as f:
+                json.dump(plan, f, indent=2, sort_keys=True)
+        except (IOError, OSError) as e:
+            raise OptimizerError("Can't write upload plan {0}: {1}"
+                                 .format(self._plan_filename, e))
+
+    def _content_encoding(self, relpath):
+        '''
+        Return the name of the original file and the content encoding of a file in the
+        output folder.
+        '''
+        if self._brotli and relpath.endswith('.br') and \
+                os.path.splitext(relpath[:-3])[1] in self._gzip_ext:
+            return relpath[:-3], 'br'
+
+        if self._gzip and os.path.splitext(relpath)[1] in self._gzip_ext:
+            return relpath, 'gzip'
+
+        return relpath, None
+
+    def _retry(self, func, description):
+        '''
+        Call func, and retry it with an increasing delay when it fails with a server or
+        socket error.
+        '''
+        for attempt in range(UPLOAD_RETRIES + 1):
+            try:
+                return func()
+            except (BotoServerError, socket.error) as e:
+                if attempt == UPLOAD_RETRIES or \
+                        (isinstance(e, BotoServerError) and e.status and e.status < 500):
+                    raise
+                delay = UPLOAD_RETRY_DELAY * 2 ** attempt
+                logger.warning("S3 request for {0} failed ({1}), retrying in {2}s"
+                               .format(description, e, delay))
+                time.sleep(delay)
+
+    def _upload_part(self, item):
+        '''
+        Upload a single part of a multipart upload, and return its ETag.
+        '''
+        abspath, relpath, upload_id, part_num, offset, part_md5 = item
+
+        def _send():
+            upload = MultiPartUpload(self._thread_bucket())
+            upload.key_name = relpath
+            upload.id = upload_id
+            with open(abspath, 'rb') as fp:
+                fp.seek(offset)
+                self._count_request('UPLOAD_PART')
+                upload.upload_part_from_file(fp, part_num, md5=part_md5[:2], size=part_md5[2])
+
+        logger.debug("Uploading part {0} of {1}".format(part_num, relpath))
+        self._retry(_send, "part {0} of {1}".format(part_num, relpath))
+        return part_md5[0]
+
+    def _initiate_multipart(self, upload):
+        '''
+        Start the multipart upload of a large file prepared by _prepare_upload, and return
+        the items of its parts for _upload_part.
+        '''
+        abspath, relpath, headers, parts, size = upload
+
+        logger.debug("Uploading file {0} to {1} in {2} parts"
+                     .format(relpath, self._destination_bucket, len(parts)))
+
+        def _initiate():
+            self._count_request('CREATE_MULTIPART')
+            return self._thread_bucket().initiate_multipart_upload(relpath, headers=headers)
+
+        upload_id = self._retry(_initiate, relpath).id
+
+        items = []
+        offset = 0
+        for part_num, part_md5 in enumerate(parts, 1):
+            items.append((abspath, relpath, upload_id, part_num, offset, part_md5))
+            offset += part_md5[2]
+        return items
+
+    def _complete_multipart(self, item):
+        '''
+        Complete a multipart upload with the ETags of its parts
+        '''
+        relpath, upload_id, etags = item
+
+        xml = '<CompleteMultipartUpload>'
+        for part_num, etag in enumerate(etags, 1):
+            xml += '<Part><PartNumber>{0}</PartNumber><ETag>"{1}"</ETag></Part>'.format(
+                part_num, etag)
+        xml += '</CompleteMultipartUpload>'
+
+        def _complete():
+            self._count_request('COMPLETE_MULTIPART')
+            return self._thread_bucket().complete_multipart_upload(relpath, upload_id, xml)
+
+        self._retry(_complete, relpath)
+
+    def _cancel_multipart(self, relpath, upload_id):
+        '''
+        Cancel a multipart upload, so its parts are not stored
+        '''
+        logger.debug("Cancelling upload of {0}".format(relpath))
+        self._count_request('ABORT_MULTIPART')
+        self._thread_bucket().cancel_multipart_upload(relpath, upload_id)
+
+    def _upload_multipart(self, upload):
+        '''
+        Upload a large file in parts from the current upload thread. The parts are retried
+        separately.
+        '''
+        items = self._initiate_multipart(upload)
+        try:
+            etags = [self._upload_part(item) for item in items]
+            self._complete_multipart((upload[1], items[0][2], etags))
+        except:
+            self._cancel_multipart(upload[1], items[0][2])
+            raise
+
+    def _upload_files(self, uploads):
+        '''
+        Upload files prepared by _prepare_upload with the upload threads. The parts of large
+        files are uploaded by the same threads, so they are sent in parallel, and only one
+        part per thread is read at a time. Returns the number of bytes uploaded.
+        '''
+        multiparts = [upload for upload in uploads if isinstance(upload[3], list)]
+        uploaded = sum(self._upload_map('_upload_file', [upload for upload in uploads
+                                                         if not isinstance(upload[3], list)]))
+        if not multiparts:
+            return uploaded
+
+        parts = []
+        try:
+            for upload in multiparts:
+                parts.append(self._initiate_multipart(upload))
+            etags = self._upload_map('_upload_part', [item for items in parts for item in items])
+            completions = []
+            for items in parts:
+                completions.append((items[0][1], items[0][2], etags[:len(items)]))
+                etags = etags[len(items):]
+            self._upload_map('_complete_multipart', completions)
+        except:
+            for items in parts:
+                self._cancel_multipart(items[0][1], items[0][2])
+            raise
+
+        for abspath, relpath, headers, file_md5, size in multiparts:
+            self._remote_headers[relpath] = headers_digest(headers)
+
+        return uploaded + sum(upload[4] for upload in multiparts)
+
+    def _prepare_upload(self, item):
+        '''
+        Prepare the upload of a single file from the output folder. Returns None when the
+        file is unchanged in the bucket, otherwise a tuple of the file, its key, headers,
+        MD5s of its parts (for multipart uploads) or of the whole file, and size.
+        '''
+        abspath, relpath = item
+
+        headers = self._upload_headers(relpath)
+
+        remote_etag, remote_size = self._remote_keys.get(relpath, (None, None))
+        remote_etag = remote_etag and remote_etag.strip('"')
+
+        size = os.path.getsize(abspath)
+        if self._multipart_threshold and size >= self._multipart_threshold:
+            parts = calculate_part_md5s(abspath, MULTIPART_PART_SIZE)
+            etag = multipart_etag(parts)
+            if remote_etag and '-' not in remote_etag and remote_size == size:
+                # copied in place, or uploaded in a single part
+                with open(abspath, 'rb') as fp:
+                    etag = remote_etag if compute_md5(fp)[0] == remote_etag else etag
+        else:
+            with open(abspath, 'rb') as fp:
+                file_md5 = compute_md5(fp)
+            parts = None
+            etag = file_md5[0]
+
+        if remote_etag is not None:
+            if remote_etag == etag and remote_size == size:
+                if self._remote_headers.get(relpath) == headers_digest(headers):
+                    logger.debug("Skipping unchanged file {0}".format(relpath))
+                    return None
+                if size <= COPY_MAX_SIZE:
+                    # contents are unchanged, only the headers are replaced
+                    return abspath, relpath, headers, None, size
+            elif self._content_encoding(relpath)[0] in self._fingerprinted_keys:
+                # a previous asset with the same truncated fingerprint, or compressed
+                # differently
+                logger.warning("Replacing {0} in the bucket, its contents differ from the asset "
+                               "with the same fingerprint".format(relpath))
+
+        return abspath, relpath, headers, parts if parts is not None else file_md5, size
+
+    def _upload_headers(self, relpath):
+        '''
+        Return the headers of a key: cache headers, content encoding and type, and the
+        headers set by the upload policy
+        '''
+        original, encoding = self._content_encoding(relpath)
+        ext = os.path.splitext(original)[1]
+
+        headers = {}
+        if original in self._fingerprinted_keys:
+            # set infinite headers, the name changes with the contents
+            headers['Cache-Control'] = "public, max-age=31556926"
+        else:
+            # set no-cache headers
+            headers['Cache-Control'] = "no-cache, max-age=0"
+
+        if encoding:
+            headers['Content-Encoding'] = encoding
+
+        try:
+            headers['Content-Type'] = self._content_types[ext]
+        except KeyError:
+            if original != relpath:
+                # variant, take the type of the original file instead of its own extension
+                content_type = mimetypes.guess_type(original)[0]
+                if content_type:
+                    headers['Content-Type'] = content_type
+
+        headers.update(self._policy_headers(original))
+
+        return headers
+
+    def _is_unchanged(self, relpath, size):
+        '''
+        Check if a fingerprinted key is in the bucket with the size and headers it would be
+        uploaded with. Truncated fingerprints can collide, so with a fingerprint length the
+        ETag is compared by _prepare_upload instead.
+        '''
+        if self._fingerprint_length is not None or relpath not in self._remote_keys:
+            return False
+        return self._remote_keys[relpath][1] == size and \
+            self._remote_headers.get(relpath) == headers_digest(self._upload_headers(relpath))
 
-    def _gzip_files(self):
+    def _upload_file(self, upload):
         '''
-        Gzip text files in output folder.
+        Upload a single file prepared by _prepare_upload. Failed uploads are retried with an
+        increasing delay. Returns the number of bytes uploaded.
         '''
+        abspath, relpath, headers, file_md5, size = upload
 
-        logger.info('Gzipping files')
+        if file_md5 is None:
+            self._copy_file(relpath, headers)
+            return 0
 
-        for dirpath, dirnames, fnames in os.walk(self._output_dir):
-            for f in fnames:
-                abspath = os.path.join(dirpath, f)
+        if isinstance(file_md5, list):
+            self._upload_multipart(upload)
+            self._remote_headers[relpath] = headers_digest(headers)
+            return size
 
-                is_gzippable = os.path.splitext(f)[1] in self._gzip_ext
-                if is_gzippable:
-                    tmp_handle, tmp_filename = mkstemp()
+        def _send():
+            k = Key(self._thread_bucket())
+            k.key = relpath
 
-                    logger.debug('Gzipping {0}'.format(abspath))
-                    with open(abspath, 'rb') as f_in:
-                        with gzip.open(tmp_filename, 'wb') as f_out:
-                            f_out.writelines(f_in)
+            logger.debug("Uploading file {0} to {1}".format(relpath, self._destination_bucket))
+            self._count_request('PUT')
+            k.set_contents_from_filename(abspath, replace=True, headers=headers, md5=file_md5[:2])
 
-                    # overwrite existing file
-                    move(tmp_filename, abspath)
+        self._retry(_send, relpath)
+        self._remote_headers[relpath] = headers_digest(headers)
+        return size
 
-        logger.debug('Finished gzipping files')
+    def _copy_file(self, relpath, headers):
+        '''
+        Replace the headers of a key whose contents are unchanged, by copying it in place
+        '''
+        metadata = {}
+        copy_headers = {}
+        for name, value in headers.items():
+            if name.startswith('x-amz-meta-'):
+                metadata[name[len('x-amz-meta-'):]] = value
+            elif name != 'x-amz-storage-class':
+                copy_headers[name] = value
+        if 'Content-Type' not in copy_headers:
+            # guessed when uploading, but not when copying
+            copy_headers['Content-Type'] = mimetypes.guess_type(relpath)[0] or \
+                'application/octet-stream'
+
+        def _send():
+            logger.debug("Updating headers of {0}".format(relpath))
+            self._count_request('COPY')
+            self._thread_bucket().copy_key(
+                relpath, self._destination_bucket, relpath, metadata=metadata,
+                storage_class=headers.get('x-amz-storage-class', 'STANDARD'),
+                headers=copy_headers)
+
+        self._retry(_send, relpath)
+        self._remote_headers[relpath] = headers_digest(headers)
+
+    def _load_remote_headers(self):
+        '''
+        Load the digests of the headers of the keys in the bucket, written by previous runs.
+        Keys without a digest are copied in place with their current headers.
+        '''
+        self._remote_headers = {}
+        key = self._bucket_key(HEADERS_FILENAME)
+        if self._remote_keys.pop(key, None) is not None:
+            def _get():
+                self._count_request('GET')
+                return Key(self._bucket, key).get_contents_as_string()
+
+            try:
+                remote_headers = json.loads(self._retry(_get, key).decode('utf-8'))
+            except ValueError as e:
+                logger.warning("Ignoring invalid header digests {0}: {1}".format(key, e))
+                remote_headers = {}
+
+            # digests of keys that are no longer in the bucket are dropped
+            self._remote_headers = dict((relpath, digest)
+                                        for relpath, digest in remote_headers.items()
+                                        if relpath in self._remote_keys)
+        self._saved_remote_headers = dict(self._remote_headers)
+
+    def _save_remote_headers(self):
+        '''
+        Write the digests of the headers of the keys in the bucket, if they changed
+        '''
+        if self._remote_headers == self._saved_remote_headers:
+            return
+
+        key = self._bucket_key(HEADERS_FILENAME)
+        contents = json.dumps(self._remote_headers, sort_keys=True)
+
+        def _send():
+            k = Key(self._bucket)
+            k.key = key
+            self._count_request('PUT')
+            k.set_contents_from_string(contents, headers={
+                'Cache-Control': "no-cache, max-age=0", 'Content-Type': 'application/json'})
+
+        logger.debug("Writing header digests {0}".format(key))
+        self._retry(_send, key)
+        self._saved_remote_headers = dict(self._remote_headers)
+
+    def _delete_keys(self, keys):
+        '''
+        Delete a batch of at most DELETE_BATCH_SIZE keys from the bucket.
+        '''
+        for del_file in keys:
+            logger.debug(
+                "Deleting key {0} from {1}".format(del_file, self._destination_bucket))
+
+        bucket = self._thread_bucket()
+
+        def _delete():
+            self._count_request('DELETE')
+            return bucket.delete_keys(keys, quiet=True)
+
+        result = self._retry(_delete, "deletion of {0} keys".format(len(keys)))
+        for error in getattr(result, 'errors', []):
+            logger.warning("Can't delete key {0}: {1}".format(error.key, error.message))
+
+    def _bucket_key(self, relpath):
+        '''
+        Return the key in the bucket of a file in the output folder
+        '''
+        if self._prefix:
+            return os.path.join(self._prefix, relpath)
+        return relpath
+
+    def _list_bucket(self):
+        '''
+        Index the keys in the bucket, to skip files that are already uploaded without
+        requesting every key
+        '''
+        self._remote_keys = {}
+        for l in self._bucket.list(prefix=self._prefix):
+            self._remote_keys[l.key] = (l.etag, l.size)
+
+        # keys are listed in pages of 1000
+        self._count_request('LIST', max(1, (len(self._remote_keys) + 999) // 1000))
+
+        self._load_remote_headers()
+
+    def _delete_stale_keys(self, to_be_deleted):
+        '''
+        Delete keys from the bucket in batches of DELETE_BATCH_SIZE
+        '''
+        batches = [to_be_deleted[i:i + DELETE_BATCH_SIZE]
+                   for i in range(0, len(to_be_deleted), DELETE_BATCH_SIZE)]
+        self._upload_map('_delete_keys', batches)
+        for relpath in to_be_deleted:
+            self._remote_headers.pop(relpath, None)
 
     def _upload_to_bucket(self):
         '''
-        Upload contents of output folder to S3.
+        Upload contents of output folder to S3. All uploads and deletions are planned
+        first, and listed before anything is sent to the bucket.
         '''
         logger.info('Uploading to bucket')
+        phase = self._start_phase('upload')
 
         try:
-            to_be_deleted = [l.key for l in self._bucket.list(prefix=self._prefix)]
+            self._list_bucket()
 
+            local_keys = set()
+            candidates = []
+            skipped = []
             for dirpath, dirnames, fnames in os.walk(self._output_dir):
 
                 for f in fnames:
                     abspath = os.path.join(dirpath, f)
                     relpath = os.path.relpath(abspath, self._output_dir)
+                    if relpath == DEPENDENCIES_FILENAME:
+                        continue
 
-                    if self._prefix:
-                        relpath = os.path.join(self._prefix, relpath)
+                    relpath = self._bucket_key(relpath)
 
                     # do not delete this file
-                    try:
-                        to_be_deleted.remove(relpath)
-                    except:
-                        pass
+                    local_keys.add(relpath)
 
                     # check if file should be cached / reuploaded
-                    ext = os.path.splitext(f)[1]
-                    is_asset = ext in self._assets_ext
-                    is_gzipped = self._gzip and (ext in self._gzip_ext)
-
-                    k = self._bucket.get_key(relpath)
-                    if k is None or not is_asset:
-                        # asset doesn't exist or file is not an asset and
-                        # should be uploaded anyway
-
-                        k = Key(self._bucket)
-                        k.key = relpath
-
-                        headers = {}
-                        if is_asset:
-                            # set infinite headers
-                            headers['Cache-Control'] = "public, max-age=31556926"
-                        else:
-                            # set no-cache headers
-                            headers['Cache-Control'] = "no-cache, max-age=0"
-
-                        if is_gzipped:
-                            headers['Content-Encoding'] = "gzip"
-
-                        try:
-                            headers['Content-Type'] = self._content_types[ext]
-                        except KeyError:
-                            pass
-
-                        logger.debug("Uploading file {0} to {1}".format(relpath,
-                                                                        self._destination_bucket))
-                        k.set_contents_from_filename(abspath, replace=True, headers=headers)
-
-            # remove files not currently touched
+                    original = self._content_encoding(relpath)[0]
+                    if original in self._fingerprinted_keys and \
+                            self._is_unchanged(relpath, os.path.getsize(abspath)):
+                        # asset names contain their fingerprint, so an existing asset
+                        # of the same size is unchanged
+                        logger.debug("Skipping existing asset {0}".format(relpath))
+                        skipped.append(relpath)
+                        continue
+
+                    candidates.append((abspath, relpath))
+
+            # remove files not currently touched, except assets uploaded by another run
+            to_be_deleted = sorted(set(self._remote_keys) - local_keys - self._external_keys())
+
+            uploads = [upload for upload in self._upload_map('_prepare_upload', candidates)
+                       if upload is not None]
+            uploaded_keys = set(upload[1] for upload in uploads)
+            skipped.extend(relpath for abspath, relpath in candidates
+                           if relpath not in uploaded_keys)
+            copies = [upload for upload in uploads if upload[3] is None]
+            uploads = [upload for upload in uploads if upload[3] is not None]
+
+            if self._plan_filename:
+                self._write_plan(uploads, copies, skipped, to_be_deleted)
+
+            # report the plan before anything is sent
+            report = logger.info if self._dry_run else logger.debug
+            for upload in uploads:
+                report("Upload {0} ({1} bytes)".format(upload[1], upload[4]))
+            for upload in copies:
+                report("Update headers of {0}".format(upload[1]))
             for del_file in to_be_deleted:
-                logger.debug(
-                    "Deleting key {0} from {1}".format(del_file, self._destination_bucket))
-            self._bucket.delete_keys(to_be_deleted)
+                report("Delete {0}".format(del_file))
+            logger.info("{0} files to upload ({1} KB), {2} headers to update, {3} keys to "
+                        "delete, {4} files unchanged"
+                        .format(len(uploads), sum(upload[4] for upload in uploads) // 1024,
+                                len(copies), len(to_be_deleted), len(skipped)))
 
-        except (BotoClientError, BotoServerError) as e:
+            if self._dry_run:
+                logger.info('Dry run, nothing was sent to the bucket')
+                self._end_phase(phase)
+                return
+
+            start = time.time()
+            uploaded = self._upload_files(uploads + copies)
+            elapsed = time.time() - start
+
+            logger.info("Uploaded {0} files ({1} KB) in {2:.1f}s, {3:.1f} KB/s"
+                        .format(len(uploads), uploaded // 1024, elapsed,
+                                uploaded / 1024.0 / max(elapsed, 0.001)))
+
+            self._delete_stale_keys(to_be_deleted)
+            self._save_remote_headers()
+
+        except (BotoClientError, BotoServerError, socket.error) as e:
             raise OptimizerError("Error uploading to S3" + str(e))
 
+        self._end_phase(phase, len(uploads), uploaded)
         logger.debug('Finished uploading to bucket')
 
+    def _start_stream(self):
+        '''
+        Start the uploader of streaming mode, which uploads files while the next ones
+        are being written.
+        '''
+        logger.info('Streaming to bucket')
+        self._stream_phase = self._start_phase('upload')
+
+        try:
+            self._list_bucket()
+        except (BotoClientError, BotoServerError, socket.error) as e:
+            raise OptimizerError("Error uploading to S3" + str(e))
+
+        self._local_keys = set()
+        self._stream_uploaded = []
+        self._stream_results = []
+
+    def _wait_stream(self, result):
+        '''
+        Wait for a single file handed to the uploader
+        '''
+        try:
+            self._stream_uploaded.extend(result.get())
+        except (BotoClientError, BotoServerError, socket.error) as e:
+            raise OptimizerError("Error uploading to S3" + str(e))
+
+    def _stream_output(self, relpath):
+        '''
+        Hand a file that was just written to the uploader. At most a few files per
+        upload thread are waiting, which bounds the disk space used by pending files.
+        '''
+        ext = os.path.splitext(relpath)[1]
+        is_compressed = (self._gzip or self._brotli) and ext in self._gzip_ext
+
+        keys = [self._bucket_key(relpath)]
+        if self._brotli and is_compressed:
+            keys.append(keys[0] + '.br')
+        self._local_keys.update(keys)
+
+        # compressed files are only written by the uploader, which compares them with the
+        # bucket after compressing them
+        src = self._stream_sources.get(relpath, os.path.join(self._output_dir, relpath))
+        if keys[0] in self._fingerprinted_keys and not is_compressed and \
+                self._is_unchanged(keys[0], os.path.getsize(src)):
+            # asset names contain their fingerprint, so an existing asset of the same size
+            # is unchanged
+            logger.debug("Skipping existing asset {0}".format(keys[0]))
+            self._stream_sources.pop(relpath, None)
+            return
+
+        while len(self._stream_results) >= self._upload_concurrency * 4:
+            self._wait_stream(self._stream_results.pop(0))
+
+        self._stream_results.append(self._upload_workers().apply_async(self._stream_upload,
+                                                                       (relpath,)))
+
+    def _stream_upload(self, relpath):
+        '''
+        Compress and upload a single file in streaming mode, and remove it from the
+        temporary output folder afterwards. Returns the sizes of the uploaded files.
+        '''
+        abspath = os.path.join(self._output_dir, relpath)
+        src = self._stream_sources.pop(relpath, abspath)
+
+        files = [(src, self._bucket_key(relpath))]
+        if (self._gzip or self._brotli) and os.path.splitext(relpath)[1] in self._gzip_ext:
+            self._compress_file(relpath, src)
+            if self._gzip:
+                files = [(abspath, self._bucket_key(relpath))]
+            if self._brotli:
+                files.append((abspath + '.br', self._bucket_key(relpath) + '.br'))
+
+        uploaded = []
+        for item in files:
+            upload = self._prepare_upload(item)
+            if upload is not None:
+                uploaded.append(self._upload_file(upload))
+
+        if self._output_dir_is_temp:
+            for path in (abspath, abspath + '.br'):
+                if os.path.isfile(path):
+                    os.remove(path)
+
+        return uploaded
+
+    def _finish_stream(self):
+        '''
+        Wait for the uploader of streaming mode, and remove stale keys from the bucket
+        '''
+        for result in self._stream_results:
+            self._wait_stream(result)
+        self._stream_results = []
+
+        elapsed = time.time() - self._stream_phase['wall']
+        uploaded = sum(self._stream_uploaded)
+        logger.info("Uploaded {0} files ({1} KB) in {2:.1f}s, {3:.1f} KB/s, "
+                    "skipped {4} unchanged files"
+                    .format(len(self._stream_uploaded), uploaded // 1024, elapsed,
+                            uploaded / 1024.0 / max(elapsed, 0.001),
+                            len(self._local_keys) - len(self._stream_uploaded)))
+
+        try:
+            # assets uploaded by another run are not deleted
+            self._delete_stale_keys(sorted(set(self._remote_keys) - self._local_keys -
+                                           self._external_keys()))
+            self._save_remote_headers()
+        except (BotoClientError, BotoServerError, socket.error) as e:
+            raise OptimizerError("Error uploading to S3" + str(e))
+
+        self._end_phase(self._stream_phase, len(self._stream_uploaded), uploaded)
+
     def run(self):
         '''
         Main entry method for the Optimizer object.
@@ -433,16 +2399,180 @@ class Optimizer(object):
         logger.debug('Running optimize')
 
         self._index_source_dir()
+        try:
+            self._build()
+        finally:
+            if not self._watch:
+                self._close_upload_workers()
+
+        logger.info('Finished optimizing static website for S3.')
+
+    def _build(self, sync=False):
+        '''
+        Fingerprint, write, compress and upload the indexed files. When syncing, only the
+        files written by this build are uploaded, see _sync_written_files.
+        '''
         self._calculate_fingerprints()
         self._write_dirs()
-        self._write_files()
-        if self._gzip:
-            self._gzip_files()
 
-        if not self._skip_s3_upload:
-            self._upload_to_bucket()
+        if self._stream:
+            # files are compressed and uploaded as soon as they are written
+            self._start_stream()
+            try:
+                self._write_files()
+            except:
+                self._close_upload_workers(terminate=True)
+                raise
+            self._finish_stream()
+        else:
+            self._write_files()
+            if self._gzip or self._brotli:
+                self._compress_files()
 
-        logger.info('Finished optimizing static website for S3.')
+            if self._skip_s3_upload:
+                pass
+            elif sync:
+                self._sync_written_files()
+            else:
+                self._upload_to_bucket()
+
+        if self._manifest_filename:
+            self._write_manifest()
+
+        if self._report_filename:
+            self._write_report()
+
+        if self._profiler is not None:
+            logger.debug("Writing profile {0}".format(self._profile_filename))
+            self._profiler.dump_stats(self._profile_filename)
+
+    def _snapshot(self):
+        '''
+        Return the size, modification time and inode of every file in the source dir that
+        is not excluded
+        '''
+        snapshot = {}
+        for subdirs, files in self._walk_source_dir():
+            for relpath in files:
+                try:
+                    st = os.stat(os.path.join(self._source_dir, relpath))
+                except OSError:
+                    # removed while walking
+                    continue
+                snapshot[relpath] = (st.st_size, st.st_mtime, st.st_ino)
+        return snapshot
+
+    def _rebuild(self, changed, reindex):
+        '''
+        Rebuild after files in the source dir changed. The index, asset map and rewrite
+        matcher are kept unless files were added or removed, and only the references of
+        changed files are searched again.
+        '''
+        self._stats['phases'] = []
+        self._stats['s3_requests'] = {}
+
+        if reindex:
+            self._subdirs = []
+            self._files = []
+            self._assets_map = {}
+            self._rewritables = []
+            self._external_assets = set()
+            self._asset_references = {}
+            self._index_source_dir()
+        else:
+            phase = self._start_phase('reference_graph')
+            for relpath in changed:
+                self._asset_references.pop(relpath, None)
+            self._build_reference_graph()
+            self._end_phase(phase, len(changed))
+
+        self._build(sync=True)
+
+    def _sync_written_files(self):
+        '''
+        Upload the files written by a rebuild in watch mode, and delete the keys of outputs
+        that are no longer produced. The bucket is not listed again.
+        '''
+        phase = self._start_phase('upload')
+
+        candidates = []
+        to_be_deleted = []
+        for relpath in self._written_files:
+            for variant in (relpath, relpath + '.br'):
+                abspath = os.path.join(self._output_dir, variant)
+                if os.path.isfile(abspath):
+                    candidates.append((abspath, self._bucket_key(variant)))
+        for relpath in self._removed_files:
+            to_be_deleted.append(self._bucket_key(relpath))
+            if self._brotli:
+                to_be_deleted.append(self._bucket_key(relpath) + '.br')
+
+        try:
+            uploads = [upload for upload in self._upload_map('_prepare_upload', candidates)
+                       if upload is not None]
+            uploaded = self._upload_files(uploads)
+            self._delete_stale_keys(sorted(to_be_deleted))
+            self._save_remote_headers()
+        except (BotoClientError, BotoServerError, socket.error) as e:
+            raise OptimizerError("Error uploading to S3" + str(e))
+
+        # keep the index of the bucket up to date for the next rebuild
+        for abspath, relpath, headers, file_md5, size in uploads:
+            if file_md5 is None:
+                # copied in place
+                continue
+            if isinstance(file_md5, list):
+                etag = multipart_etag(file_md5)
+            else:
+                etag = file_md5[0]
+            self._remote_keys[relpath] = ('"{0}"'.format(etag), size)
+        for relpath in to_be_deleted:
+            self._remote_keys.pop(relpath, None)
+
+        logger.info("Uploaded {0} files ({1} KB), deleted {2} keys"
+                    .format(len(uploads), uploaded // 1024, len(to_be_deleted)))
+        self._end_phase(phase, len(uploads), uploaded)
+
+    def watch(self, interval=WATCH_INTERVAL):
+        '''
+        Run, and rebuild whenever files in the source dir change, until interrupted. The
+        source dir is polled every interval seconds.
+        '''
+        # changes made during the first run are picked up by the first poll
+        snapshot = self._snapshot()
+        self.run()
+
+        reindex = False
+        logger.info("Watching {0} for changes".format(self._source_dir))
+        try:
+            while True:
+                time.sleep(interval)
+                current = self._snapshot()
+                if current == snapshot:
+                    continue
+
+                changed = set(relpath for relpath in set(snapshot) | set(current)
+                              if snapshot.get(relpath) != current.get(relpath))
+                # a new or removed file changes the index and the rewrite matcher
+                reindex = reindex or set(snapshot) != set(current)
+                snapshot = current
+
+                start = time.time()
+                try:
+                    self._rebuild(changed, reindex)
+                except (OptimizerError, IOError, OSError) as e:
+                    # rebuild everything after the next change
+                    logger.error("Rebuild failed: {0}".format(e))
+                    reindex = True
+                    continue
+
+                reindex = False
+                logger.info("Rebuilt {0} changed files in {1:.2f}s"
+                            .format(len(changed), time.time() - start))
+        except KeyboardInterrupt:
+            logger.info('Stopped watching')
+        finally:
+            self._close_upload_workers()
 
 
 def main():
@@ -468,7 +2598,8 @@ def main():
     parser.add_argument("source_dir", help='Local directory containing a static website.')
     parser.add_argument("destination_bucket", help='S3 bucket name.')
     parser.add_argument('--exclude', nargs='+', metavar="PATTERN", default=[],
-                        help='Exclude files and directories matching these patterns.')
+                        help='Exclude files and directories matching these patterns. \
+                        Nothing under an excluded directory is indexed.')
     parser.add_argument('--skip-assets', nargs='+', metavar="PATTERN", default=[],
                         help='Do not fingerprint assets matching these patterns.')
     parser.add_argument('-o', '--output', dest='output_dir', default=None,
@@ -482,6 +2613,15 @@ def main():
                         environment or credentials files will be used.')
     parser.add_argument('--region', default=None, help='AWS region to connect to.')
     parser.add_argument('--gzip', action='store_true', help='Gzip text-based files.', default=False)
+    parser.add_argument('--gzip-level', type=int, default=9, metavar='LEVEL',
+                        help='Gzip compression level, from 1 (fastest) to 9 (smallest). \
+                        Defaults to 9.')
+    parser.add_argument('--brotli', action='store_true', default=False,
+                        help='Write a Brotli compressed variant with a .br extension next to \
+                        each text-based file. Requires the brotli module.')
+    parser.add_argument('--brotli-level', type=int, default=11, metavar='LEVEL',
+                        help='Brotli compression level, from 0 (fastest) to 11 (smallest). \
+                        Defaults to 11.')
     parser.add_argument('--prefix', default=None, help='Subdirectory in which files are stored in \
                                                         the bucket. Stored in the root of the \
                                                         bucket by default.')
@@ -489,6 +2629,72 @@ def main():
                         help='Domain names on which the site will be hosted.')
     parser.add_argument('--skip-s3-upload', dest="skip_s3_upload",
                         action='store_true', help='Skip uploading to S3.')
+    parser.add_argument('--link-mode', choices=LINK_MODES, default='copy',
+                        help='How files that are not rewritten are placed into the output \
+                        directory. Links fall back to copies when they can\'t be made. \
+                        Defaults to copy.')
+    parser.add_argument('--cache', default=None, metavar='CACHE_FILE',
+                        help='File in which fingerprints of assets are cached between runs. \
+                        Assets that did not change since the previous run are not read again.')
+    parser.add_argument('--incremental', action='store_true', default=False,
+                        help='Only write files whose source or referenced assets changed since \
+                        the previous run into the output directory. Requires --output.')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true', default=False,
+                        help='List the keys that would be uploaded to and deleted from S3, \
+                        without changing the bucket.')
+    parser.add_argument('--stream', action='store_true', default=False,
+                        help='Compress and upload every file as soon as it is written, \
+                        instead of after writing the whole site. Unless --output is given, \
+                        unchanged files are uploaded from the source directory and written \
+                        files are removed after their upload.')
+    parser.add_argument('--upload-concurrency', type=int, default=1, metavar='N',
+                        help='Number of files uploaded to S3 in parallel. Defaults to 1.')
+    parser.add_argument('--multipart-threshold', type=int, metavar='MB',
+                        default=MULTIPART_THRESHOLD // (1024 * 1024),
+                        help='Files of at least this size are uploaded to S3 in parts, which \
+                        are sent in parallel and retried separately. 0 disables multipart \
+                        uploads. Defaults to 64 MB.')
+    parser.add_argument('--hash', dest='hash_algorithm', choices=HASH_ALGORITHMS,
+                        default='sha256',
+                        help='Hash algorithm of fingerprints. blake2b requires Python 3.6, \
+                        xxh64 requires the xxhash module. Defaults to sha256.')
+    parser.add_argument('--hash-buffer', type=int, default=64, metavar='KB',
+                        help='Size of the chunks in which files are read to calculate their \
+                        fingerprint. Defaults to 64 KB.')
+    parser.add_argument('--fingerprint-length', type=int, default=None, metavar='N',
+                        help='Number of characters of the fingerprint included in filenames, \
+                        at least {0}. The whole fingerprint is included by default.'
+                        .format(FINGERPRINT_MIN_LENGTH))
+    parser.add_argument('--watch', nargs='?', type=float, const=WATCH_INTERVAL, default=None,
+                        metavar='SECONDS',
+                        help='Keep running, and rebuild the files affected by every change in \
+                        the source dir. Only the rebuilt files are uploaded. The source dir is \
+                        polled every 0.5 seconds by default. Requires --output.')
+    parser.add_argument('--dedupe', nargs='?', const=DEDUPE_DIR, default=None, metavar='DIR',
+                        help='Write and upload assets with identical contents once, into this \
+                        dir, and reference that copy from every file. Defaults to {0}.'
+                        .format(DEDUPE_DIR))
+    parser.add_argument('--policy', default=None, metavar='POLICY_FILE',
+                        help='JSON file with rules that set the Cache-Control, Content-Type, \
+                        storage class or metadata of files matching their patterns.')
+    parser.add_argument('--plan', default=None, metavar='PLAN_FILE',
+                        help='Write the planned uploads, header updates, skipped files and \
+                        deletions to this file as JSON before anything is sent to the bucket.')
+    parser.add_argument('--manifest', default=None, metavar='MANIFEST_FILE',
+                        help='Write the fingerprinted name, fingerprint and size of every asset \
+                        to this file as JSON.')
+    parser.add_argument('--from-manifest', default=None, metavar='MANIFEST_FILE',
+                        help='Reference the assets in a manifest written by another run by \
+                        their fingerprinted names. These assets are not fingerprinted, written \
+                        or uploaded, and are not deleted from the bucket.')
+    parser.add_argument('--report', default=None, metavar='REPORT_FILE',
+                        help='Write the time spent, files and bytes processed in every phase, \
+                        and the number of S3 requests to this file as JSON.')
+    parser.add_argument('--profile', default=None, metavar='PROFILE_FILE',
+                        help='Profile rewriting files with cProfile, and write the stats to \
+                        this file. Files are rewritten in a single process while profiling.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of files processed in parallel. Defaults to 1.')
 
     try:
         args = parser.parse_args()
@@ -503,12 +2709,26 @@ def main():
         logger.setLevel(logging.INFO)
 
     try:
-        Optimizer(args.source_dir, args.destination_bucket,
-                  exclude=args.exclude, skip_assets=args.skip_assets,
-                  output_dir=args.output_dir, aws_access_key_id=args.aws_access_key_id,
-                  aws_secret_access_key=args.aws_secret_access_key,
-                  skip_s3_upload=args.skip_s3_upload, region=args.region,
-                  domains=args.domains, prefix=args.prefix, gzip=args.gzip).run()
+        optimizer = Optimizer(
+            args.source_dir, args.destination_bucket, exclude=args.exclude,
+            skip_assets=args.skip_assets, output_dir=args.output_dir,
+            aws_access_key_id=args.aws_access_key_id,
+            aws_secret_access_key=args.aws_secret_access_key,
+            skip_s3_upload=args.skip_s3_upload, region=args.region, domains=args.domains,
+            prefix=args.prefix, gzip=args.gzip, jobs=args.jobs, cache=args.cache,
+            incremental=args.incremental, upload_concurrency=args.upload_concurrency,
+            multipart_threshold=args.multipart_threshold * 1024 * 1024,
+            dry_run=args.dry_run, gzip_level=args.gzip_level, brotli=args.brotli,
+            brotli_level=args.brotli_level, stream=args.stream, link_mode=args.link_mode,
+            report=args.report, profile=args.profile, manifest=args.manifest,
+            from_manifest=args.from_manifest, hash_algorithm=args.hash_algorithm,
+            hash_blocksize=args.hash_buffer * 1024,
+            fingerprint_length=args.fingerprint_length, watch=args.watch is not None,
+            dedupe=args.dedupe, policy=args.policy, plan=args.plan)
+        if args.watch is not None:
+            optimizer.watch(args.watch)
+        else:
+            optimizer.run()
     except Exception as e:
         logger.critical(e)
         exit(1)
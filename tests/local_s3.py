@@ -0,0 +1,166 @@
+'''
+In-memory stand-ins for the boto S3 classes used by the optimizer, for tests and
+benchmarks. Objects are stored with their contents, ETag and headers.
+'''
+
+import threading
+import time
+from hashlib import md5
+
+from s3_site_cache_optimizer import optimize
+
+
+class LocalObject(object):
+    '''
+    An object stored in a LocalBucket
+    '''
+
+    def __init__(self, data, headers=None, etag=None):
+        self.data = data
+        self.headers = dict(headers or {})
+        self.etag = etag or '"{0}"'.format(md5(data).hexdigest())
+        self.size = len(data)
+
+
+class LocalKey(object):
+    '''
+    Stand-in for boto.s3.key.Key, storing objects in a LocalBucket
+    '''
+
+    def __init__(self, bucket=None, name=None):
+        self.bucket = bucket
+        self.key = name
+
+    def set_contents_from_filename(self, filename, replace=True, headers=None, md5=None):
+        with open(filename, 'rb') as f:
+            self.bucket.put(self.key, f.read(), headers)
+
+    def set_contents_from_string(self, contents, headers=None):
+        self.bucket.put(self.key, contents.encode('utf-8'), headers)
+
+    def get_contents_as_string(self):
+        return self.bucket.get(self.key)
+
+
+class LocalMultiPartUpload(object):
+    '''
+    Stand-in for boto.s3.multipart.MultiPartUpload
+    '''
+
+    def __init__(self, bucket=None):
+        self.bucket = bucket
+        self.key_name = None
+        self.id = None
+
+    def upload_part_from_file(self, fp, part_num, md5=None, size=None):
+        self.bucket.put_part(self.id, part_num, fp.read(size))
+
+
+class LocalListedKey(object):
+    def __init__(self, key, etag, size):
+        self.key = key
+        self.etag = etag
+        self.size = size
+
+
+class LocalBucket(object):
+    '''
+    In-memory stand-in for a boto S3 bucket. Every request waits `latency` seconds to
+    simulate the network, and is counted by type.
+    '''
+
+    def __init__(self, name, latency=0.0):
+        self.name = name
+        self.latency = latency
+        self.objects = {}
+        self.requests = {}
+        self._uploads = {}
+        self._upload_count = 0
+        self._lock = threading.Lock()
+
+    def _request(self, request_type):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests[request_type] = self.requests.get(request_type, 0) + 1
+
+    def put(self, key, data, headers=None):
+        self._request('PUT')
+        with self._lock:
+            self.objects[key] = LocalObject(data, headers)
+
+    def get(self, key):
+        self._request('GET')
+        return self.objects[key].data
+
+    def list(self, prefix=None):
+        self._request('LIST')
+        return [LocalListedKey(key, obj.etag, obj.size)
+                for key, obj in sorted(self.objects.items())
+                if not prefix or key.startswith(prefix)]
+
+    def delete_keys(self, keys, quiet=False):
+        self._request('DELETE')
+        with self._lock:
+            for key in keys:
+                self.objects.pop(key, None)
+
+    def copy_key(self, new_key_name, src_bucket_name, src_key_name, metadata=None,
+                 storage_class='STANDARD', headers=None):
+        self._request('COPY')
+        headers = dict(headers or {})
+        for name, value in (metadata or {}).items():
+            headers['x-amz-meta-' + name] = value
+        if storage_class != 'STANDARD':
+            headers['x-amz-storage-class'] = storage_class
+        with self._lock:
+            # a copy gets the ETag of an object uploaded in a single part
+            self.objects[new_key_name] = LocalObject(self.objects[src_key_name].data, headers)
+
+    def initiate_multipart_upload(self, key, headers=None):
+        self._request('INITIATE')
+        upload = LocalMultiPartUpload(self)
+        upload.key_name = key
+        with self._lock:
+            self._upload_count += 1
+            upload.id = str(self._upload_count)
+            self._uploads[upload.id] = (headers, {})
+        return upload
+
+    def put_part(self, upload_id, part_num, data):
+        self._request('UPLOAD_PART')
+        with self._lock:
+            self._uploads[upload_id][1][part_num] = data
+
+    def complete_multipart_upload(self, key, upload_id, xml):
+        self._request('COMPLETE')
+        with self._lock:
+            headers, upload = self._uploads.pop(upload_id)
+            parts = [upload[part_num] for part_num in sorted(upload)]
+            digests = b''.join(md5(part).digest() for part in parts)
+            etag = '"{0}-{1}"'.format(md5(digests).hexdigest(), len(parts))
+            self.objects[key] = LocalObject(b''.join(parts), headers, etag)
+
+    def cancel_multipart_upload(self, key, upload_id):
+        self._request('ABORT')
+        with self._lock:
+            self._uploads.pop(upload_id, None)
+
+
+class LocalOptimizer(optimize.Optimizer):
+    '''
+    Optimizer that uploads to a LocalBucket instead of S3
+    '''
+
+    bucket = None
+
+    def _connect_bucket(self, validate=True):
+        return None, self.bucket
+
+
+def install():
+    '''
+    Replace boto's request classes used by the optimizer with the stand-ins
+    '''
+    optimize.Key = LocalKey
+    optimize.MultiPartUpload = LocalMultiPartUpload
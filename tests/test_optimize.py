@@ -0,0 +1,183 @@
+import filecmp
+import gzip
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from s3_site_cache_optimizer.optimize import DEPENDENCIES_FILENAME, Optimizer, OptimizerError
+
+
+def write_site(source_dir):
+    '''
+    Write a small website, with pages and stylesheets referencing assets
+    '''
+    os.makedirs(os.path.join(source_dir, 'css'))
+    os.makedirs(os.path.join(source_dir, 'img'))
+    for i in range(4):
+        with open(os.path.join(source_dir, 'img', 'logo{0}.png'.format(i)), 'wb') as f:
+            f.write(os.urandom(64))
+    for i in range(2):
+        with open(os.path.join(source_dir, 'css', 'style{0}.css'.format(i)), 'w') as f:
+            f.write('body {{ background: url("../img/logo{0}.png"); }}\n'.format(i))
+    for i in range(6):
+        with open(os.path.join(source_dir, 'page{0}.html'.format(i)), 'w') as f:
+            f.write('<link href="/css/style{0}.css">\n<img src="img/logo{1}.png">\n'
+                    .format(i % 2, i % 4))
+
+
+def list_tree(root_dir):
+    '''
+    Return the relative paths of the files in a dir, without the dependency manifest
+    '''
+    relpaths = []
+    for dirpath, dirnames, fnames in os.walk(root_dir):
+        for fname in fnames:
+            relpath = os.path.relpath(os.path.join(dirpath, fname), root_dir)
+            if relpath != DEPENDENCIES_FILENAME:
+                relpaths.append(relpath)
+    return sorted(relpaths)
+
+
+class TreeTestCase(unittest.TestCase):
+
+    def assertSameTree(self, first, second):
+        relpaths = list_tree(first)
+        self.assertEqual(relpaths, list_tree(second))
+        for relpath in relpaths:
+            self.assertTrue(filecmp.cmp(os.path.join(first, relpath),
+                                        os.path.join(second, relpath), shallow=False),
+                            relpath)
+
+
+class SpawnTest(TreeTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp, 'site')
+        write_site(self.source_dir)
+        self.start_method = multiprocessing.get_start_method()
+        multiprocessing.set_start_method('spawn', force=True)
+
+    def tearDown(self):
+        multiprocessing.set_start_method(self.start_method, force=True)
+        shutil.rmtree(self.tmp)
+
+    def optimize(self, name, jobs):
+        output_dir = os.path.join(self.tmp, name)
+        Optimizer(self.source_dir, 'bucket', output_dir=output_dir, skip_s3_upload=True,
+                  jobs=jobs).run()
+        return output_dir
+
+    def test_jobs_match_sequential_run(self):
+        sequential = self.optimize('sequential', 1)
+        parallel = self.optimize('parallel', 2)
+
+        self.assertSameTree(sequential, parallel)
+
+
+class BuildTest(TreeTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp, 'site')
+        write_site(self.source_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def optimize(self, name, **options):
+        output_dir = os.path.join(self.tmp, name)
+        Optimizer(self.source_dir, 'bucket', output_dir=output_dir, skip_s3_upload=True,
+                  **options).run()
+        return output_dir
+
+    def test_incremental_run_matches_full_build(self):
+        incremental = self.optimize('incremental', incremental=True)
+        with open(os.path.join(self.source_dir, 'css', 'style0.css'), 'a') as f:
+            f.write('p { color: red; }\n')
+        with open(os.path.join(self.source_dir, 'img', 'logo1.png'), 'wb') as f:
+            f.write(os.urandom(64))
+        os.remove(os.path.join(self.source_dir, 'page5.html'))
+        with open(os.path.join(self.source_dir, 'page6.html'), 'w') as f:
+            f.write('<img src="img/logo3.png">\n')
+
+        self.optimize('incremental', incremental=True)
+        self.assertSameTree(incremental, self.optimize('full'))
+
+    def test_cycles_are_written_under_original_names(self):
+        for name, other in (('a', 'b'), ('b', 'a')):
+            with open(os.path.join(self.source_dir, 'css', name + '.css'), 'w') as f:
+                f.write('@import url("{0}.css");\n'.format(other))
+        with open(os.path.join(self.source_dir, 'cycle.html'), 'w') as f:
+            f.write('<link href="/css/a.css">\n')
+
+        output_dir = self.optimize('output', incremental=True)
+
+        with open(os.path.join(output_dir, 'cycle.html')) as f:
+            fingerprinted = f.read()[len('<link href="/'):-len('">\n')]
+        self.assertNotEqual(fingerprinted, 'css/a.css')
+        for relpath in (fingerprinted, 'css/a.css', 'css/b.css'):
+            with open(os.path.join(output_dir, relpath)) as f:
+                self.assertTrue(f.read().startswith('@import url("'))
+
+        # the original names are removed once the cycle is gone
+        with open(os.path.join(self.source_dir, 'css', 'b.css'), 'w') as f:
+            f.write('p { color: red; }\n')
+        self.optimize('output', incremental=True)
+        self.assertFalse(os.path.exists(os.path.join(output_dir, 'css', 'a.css')))
+        self.assertFalse(os.path.exists(os.path.join(output_dir, 'css', 'b.css')))
+
+    def test_dedupe_writes_identical_assets_once(self):
+        shutil.copy(os.path.join(self.source_dir, 'img', 'logo0.png'),
+                    os.path.join(self.source_dir, 'img', 'copy.png'))
+        with open(os.path.join(self.source_dir, 'copy.html'), 'w') as f:
+            f.write('<img src="img/copy.png">\n<img src="img/logo0.png">\n')
+
+        output_dir = self.optimize('output', dedupe='_assets')
+
+        relpaths = list_tree(output_dir)
+        deduped = [relpath for relpath in relpaths if relpath.startswith('_assets')]
+        self.assertEqual(len(deduped), 1)
+        self.assertFalse([relpath for relpath in relpaths if 'logo0' in relpath and
+                          not relpath.startswith('_assets')])
+        with open(os.path.join(output_dir, 'copy.html')) as f:
+            self.assertEqual(f.read(), '<img src="/{0}">\n<img src="/{0}">\n'.format(deduped[0]))
+
+    def test_dedupe_compresses_rewritten_assets_once(self):
+        shutil.copy(os.path.join(self.source_dir, 'css', 'style0.css'),
+                    os.path.join(self.source_dir, 'css', 'copy.css'))
+
+        output_dir = self.optimize('output', dedupe='_assets', gzip=True)
+
+        deduped = [relpath for relpath in list_tree(output_dir) if relpath.startswith('_assets')]
+        self.assertEqual(len(deduped), 1)
+        with gzip.open(os.path.join(output_dir, deduped[0])) as f:
+            self.assertTrue(f.read().startswith(b'body { background: url('))
+
+
+class OptionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp, 'site')
+        write_site(self.source_dir)
+        self.tempdir = tempfile.tempdir
+        tempfile.tempdir = os.path.join(self.tmp, 'tmp')
+        os.mkdir(tempfile.tempdir)
+
+    def tearDown(self):
+        tempfile.tempdir = self.tempdir
+        shutil.rmtree(self.tmp)
+
+    def test_invalid_options_leave_no_temporary_dir(self):
+        for options in ({'jobs': 0}, {'upload_concurrency': 0}, {'gzip_level': 10},
+                        {'fingerprint_length': 4}, {'link_mode': 'move'}):
+            self.assertRaises(OptimizerError, Optimizer, self.source_dir, 'bucket',
+                              skip_s3_upload=True, **options)
+        self.assertEqual(os.listdir(tempfile.tempdir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from s3_site_cache_optimizer import optimize
+
+from local_s3 import LocalBucket, LocalObject, LocalOptimizer, install
+from test_optimize import write_site
+
+
+class UploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.boto_classes = optimize.Key, optimize.MultiPartUpload
+        install()
+        self.tmp = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp, 'site')
+        write_site(self.source_dir)
+        LocalOptimizer.bucket = self.bucket = LocalBucket('bucket')
+        self.part_size = optimize.MULTIPART_PART_SIZE
+
+    def tearDown(self):
+        optimize.Key, optimize.MultiPartUpload = self.boto_classes
+        optimize.MULTIPART_PART_SIZE = self.part_size
+        shutil.rmtree(self.tmp)
+
+    def optimize(self, **options):
+        self.bucket.requests = {}
+        LocalOptimizer(self.source_dir, 'bucket', **options).run()
+        return self.bucket.requests
+
+    def site_keys(self):
+        return sorted(key for key in self.bucket.objects
+                      if key != optimize.HEADERS_FILENAME)
+
+    def test_upload_sets_cache_headers(self):
+        self.optimize()
+
+        keys = self.site_keys()
+        self.assertEqual(len(keys), 12)
+        for key in keys:
+            headers = self.bucket.objects[key].headers
+            if key.startswith('page'):
+                self.assertEqual(headers['Cache-Control'], 'no-cache, max-age=0')
+            else:
+                # css and images are fingerprinted
+                self.assertEqual(headers['Cache-Control'], 'public, max-age=31556926')
+
+    def test_cycles_are_uploaded_under_original_names(self):
+        for name, other in (('a', 'b'), ('b', 'a')):
+            with open(os.path.join(self.source_dir, 'css', name + '.css'), 'w') as f:
+                f.write('@import url("{0}.css");\n'.format(other))
+
+        for options in ({}, {'stream': True}):
+            self.optimize(**options)
+            for key in ('css/a.css', 'css/b.css'):
+                self.assertEqual(self.bucket.objects[key].headers['Cache-Control'],
+                                 'no-cache, max-age=0')
+
+    def test_unchanged_site_is_not_uploaded(self):
+        self.optimize(upload_concurrency=4)
+        objects = dict(self.bucket.objects)
+
+        requests = self.optimize(upload_concurrency=4)
+        self.assertEqual(requests, {'LIST': 1, 'GET': 1})
+        self.assertEqual(self.bucket.objects, objects)
+
+    def test_changed_page_is_uploaded(self):
+        self.optimize()
+        with open(os.path.join(self.source_dir, 'page0.html'), 'a') as f:
+            f.write('<p>changed</p>\n')
+
+        requests = self.optimize()
+        # the headers are the same, their digests are not written again
+        self.assertEqual(requests, {'LIST': 1, 'GET': 1, 'PUT': 1})
+        self.assertTrue(self.bucket.objects['page0.html'].data.endswith(b'changed</p>\n'))
+
+    def replace_asset(self, data):
+        '''
+        Replace an uploaded image with other contents, keeping its headers
+        '''
+        key = [key for key in self.site_keys() if key.startswith('img/logo0.')][0]
+        obj = self.bucket.objects[key]
+        self.bucket.objects[key] = LocalObject(data, obj.headers)
+        return key, obj
+
+    def test_existing_asset_of_other_size_is_replaced(self):
+        for options in ({}, {'stream': True}):
+            self.optimize(**options)
+            key, obj = self.replace_asset(b'stale')
+
+            requests = self.optimize(**options)
+            self.assertEqual(requests['PUT'], 1)
+            self.assertEqual(self.bucket.objects[key].data, obj.data)
+
+    def test_existing_asset_is_compared_with_fingerprint_length(self):
+        self.optimize(fingerprint_length=8)
+        # the images have 64 bytes
+        key, obj = self.replace_asset(b'0' * 64)
+
+        with self.assertLogs('s3-site-cache-optimizer', 'WARNING') as logs:
+            requests = self.optimize(fingerprint_length=8)
+        self.assertEqual(requests['PUT'], 1)
+        self.assertEqual(self.bucket.objects[key].data, obj.data)
+        self.assertIn('Replacing {0}'.format(key), logs.output[0])
+
+    def test_stale_keys_are_deleted_in_batches(self):
+        for i in range(2500):
+            self.bucket.objects['old/{0}'.format(i)] = LocalObject(b'old')
+
+        requests = self.optimize(upload_concurrency=4)
+        self.assertEqual(requests['DELETE'], 3)
+        self.assertEqual(len(self.site_keys()), 12)
+
+    def test_dry_run_writes_plan_and_sends_nothing(self):
+        self.optimize()
+        self.bucket.objects['old'] = LocalObject(b'old')
+        with open(os.path.join(self.source_dir, 'page0.html'), 'a') as f:
+            f.write('<p>changed</p>\n')
+        objects = dict(self.bucket.objects)
+
+        plan_filename = os.path.join(self.tmp, 'plan.json')
+        requests = self.optimize(dry_run=True, plan=plan_filename)
+        self.assertEqual(requests, {'LIST': 1, 'GET': 1})
+        self.assertEqual(self.bucket.objects, objects)
+
+        with open(plan_filename) as f:
+            plan = json.load(f)
+        self.assertEqual([put['key'] for put in plan['put']], ['page0.html'])
+        self.assertEqual(plan['delete'], ['old'])
+        self.assertEqual(plan['copy'], [])
+        self.assertEqual(len(plan['skip']), 11)
+
+    def test_changed_headers_are_copied_in_place(self):
+        self.optimize()
+        policy_filename = os.path.join(self.tmp, 'policy.json')
+        with open(policy_filename, 'w') as f:
+            json.dump({'rules': [{'pattern': '*.html', 'cache_control': 'public, max-age=60',
+                                  'metadata': {'team': 'web'}}]}, f)
+
+        requests = self.optimize(policy=policy_filename)
+        self.assertEqual(requests, {'LIST': 1, 'GET': 1, 'COPY': 6, 'PUT': 1})
+        headers = self.bucket.objects['page0.html'].headers
+        self.assertEqual(headers['Cache-Control'], 'public, max-age=60')
+        self.assertEqual(headers['x-amz-meta-team'], 'web')
+        self.assertEqual(headers['Content-Type'], 'text/html')
+
+        requests = self.optimize(policy=policy_filename)
+        self.assertEqual(requests, {'LIST': 1, 'GET': 1})
+
+    def test_multipart_uploads_match_etags(self):
+        self.optimize()
+        objects = dict((key, obj.data) for key, obj in self.bucket.objects.items())
+
+        LocalOptimizer.bucket = self.bucket = LocalBucket('bucket')
+        optimize.MULTIPART_PART_SIZE = 16
+        requests = self.optimize(multipart_threshold=1, upload_concurrency=4)
+        self.assertEqual(requests['INITIATE'], 12)
+        self.assertEqual(dict((key, obj.data) for key, obj in self.bucket.objects.items()),
+                         objects)
+        obj = self.bucket.objects['page0.html']
+        self.assertTrue(obj.etag.endswith('-{0}"'.format((obj.size + 15) // 16)))
+
+        requests = self.optimize(multipart_threshold=1, upload_concurrency=4)
+        self.assertEqual(requests, {'LIST': 1, 'GET': 1})
+
+        # copied objects have the ETag of a single part upload
+        policy_filename = os.path.join(self.tmp, 'policy.json')
+        with open(policy_filename, 'w') as f:
+            json.dump({'rules': [{'pattern': '*', 'metadata': {'team': 'web'}}]}, f)
+        self.optimize(multipart_threshold=1, upload_concurrency=4, policy=policy_filename)
+        requests = self.optimize(multipart_threshold=1, upload_concurrency=4,
+                                 policy=policy_filename)
+        self.assertEqual(requests, {'LIST': 1, 'GET': 1})
+
+    def test_stream_uploads_same_objects(self):
+        self.optimize(gzip=True, upload_concurrency=4)
+        objects = dict((key, obj.data) for key, obj in self.bucket.objects.items())
+
+        LocalOptimizer.bucket = self.bucket = LocalBucket('bucket')
+        self.optimize(gzip=True, upload_concurrency=4, stream=True)
+        self.assertEqual(dict((key, obj.data) for key, obj in self.bucket.objects.items()),
+                         objects)
+
+    def test_stream_uploads_deduplicated_assets_once(self):
+        shutil.copy(os.path.join(self.source_dir, 'css', 'style0.css'),
+                    os.path.join(self.source_dir, 'css', 'copy.css'))
+
+        requests = self.optimize(gzip=True, upload_concurrency=4, stream=True,
+                                 dedupe='_assets')
+        deduped = [key for key in self.bucket.objects if key.startswith('_assets/')]
+        self.assertEqual(len(deduped), 1)
+        # the site with a single stylesheet for both copies, and the digests of the headers
+        self.assertEqual(requests['PUT'], 13 - 2 + 1 + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()